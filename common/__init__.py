@@ -0,0 +1,10 @@
+"""Modules shared by the v1 and v2 converters.
+
+- token_diff: token diff engines behind --diff-engine and --check-diff
+- stage_profile: per-stage profiler behind --profile
+- slot_server: local viewer server behind --serve
+
+The converters are run as scripts from their own directories and put the
+repository root on sys.path to import this package, so common/ has to stay next
+to v1/ and v2/.
+"""
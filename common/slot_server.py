@@ -0,0 +1,178 @@
+"""Local viewer server behind the converters' --serve option.
+
+Instead of precomputing every paragraph and serving static JSON with
+python -m http.server, the server keeps a converter's parsed model in memory and
+answers the viewer's requests for sharded output (manifest.json,
+shard-NNNNN.json, or any range as content?start=A&end=B) by building only the
+requested paragraphs. Built entries are kept in a bounded LRU cache. Every
+response carries an ETag computed from the paragraphs' content keys without
+building them, so a revalidating request (If-None-Match) gets 304 Not Modified
+for nothing but a hash. Other paths are served from the viewer's directory.
+
+A source (vm_to_slot.LazySlotSource, compare_with_notes_aligned.LazyComparisonSource)
+provides:
+
+    prefix              URL directory of the sharded output, e.g. "slot_output/"
+    refresh()           reload the model if its input files changed
+    total()             number of paragraphs
+    manifest()          manifest document without "total", "shard_size" and "shards"
+    keys(start, end)    content key per paragraph; a key changes whenever its entry would
+                        change, i.e. when the <l> XML, the witness setup, the diff
+                        settings or CONVERTER_VERSION change (v2), or an edition file
+                        or an option changes (v1)
+    build(idx)          entry of paragraph idx
+
+Sources are not thread-safe; requests are handled in threads, but the model is
+only touched under one lock.
+"""
+import hashlib
+import json
+import re
+import sys
+import threading
+from collections import OrderedDict
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+SHARD_RE = re.compile(r"shard-(\d+)\.json")
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+def make_etag(parts: List[str]) -> str:
+    return '"' + hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()[:32] + '"'
+
+
+class LazyShards:
+    # Sharded output of a source, built paragraph by paragraph as it is requested.
+    def __init__(self, source, shard_size: int = 50, cache_size: int = 2000):
+        self.source = source
+        self.shard_size = shard_size
+        self.cache = LRUCache(cache_size)
+        self.lock = threading.Lock()
+
+    def entries(self, start: int, keys: List[str]) -> List[Dict]:
+        entries = []
+        for idx, key in enumerate(keys, start):
+            entry = self.cache.get(key)
+            if entry is None:
+                entry = self.source.build(idx)
+                self.cache.put(key, entry)
+            entries.append(entry)
+        return entries
+
+    def make_manifest(self, total: int) -> Dict:
+        manifest = self.source.manifest()
+        manifest["total"] = total
+        manifest["shard_size"] = self.shard_size
+        manifest["shards"] = [
+            {"file": f"shard-{n:05d}.json", "start": start, "end": min(start + self.shard_size, total)}
+            for n, start in enumerate(range(0, total, self.shard_size))
+        ]
+        return manifest
+
+    def route(self, name: str, query: Dict[str, str]) -> Optional[Tuple[str, callable]]:
+        # (ETag, function building the JSON document) for a file of the sharded output,
+        # or None if there is no such file. Call with the lock held.
+        self.source.refresh()
+        total = self.source.total()
+        if name == "manifest.json":
+            keys = self.source.keys(0, total)
+            return make_etag(["manifest", str(self.shard_size)] + keys), lambda: self.make_manifest(total)
+        match = SHARD_RE.fullmatch(name)
+        if match:
+            start = int(match.group(1)) * self.shard_size
+            end = min(start + self.shard_size, total)
+        elif name == "content":
+            start = int(query.get("start", 0))
+            end = min(int(query.get("end", start + self.shard_size)), total)
+        else:
+            return None
+        if not 0 <= start < end:
+            return None
+        keys = self.source.keys(start, end)
+        return (make_etag([name, str(start)] + keys),
+                lambda: {"start": start, "content": self.entries(start, keys)})
+
+
+class LazyShardHandler(SimpleHTTPRequestHandler):
+    shards: LazyShards = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        prefix = "/" + self.shards.source.prefix
+        if not url.path.startswith(prefix):
+            return super().do_GET()
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            with self.shards.lock:
+                found = self.shards.route(url.path[len(prefix):], query)
+                if found is None:
+                    self.send_error(HTTPStatus.NOT_FOUND)
+                    return
+                etag, build = found
+                if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+                    self.send_response(HTTPStatus.NOT_MODIFIED)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                body = json.dumps(build(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        except ValueError as exc:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(exc))
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        # Revalidate on every use; unchanged paragraphs cost a 304.
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(source, host: str = "127.0.0.1", port: int = 8000, directory: str = ".",
+                shard_size: int = 50, cache_size: int = 2000) -> ThreadingHTTPServer:
+    shards = LazyShards(source, shard_size, cache_size)
+    handler = type("Handler", (LazyShardHandler,), {"shards": shards})
+    server = ThreadingHTTPServer((host, port), partial(handler, directory=directory))
+    server.shards = shards
+    return server
+
+
+def serve(source, host: str = "127.0.0.1", port: int = 8000, directory: str = ".",
+          shard_size: int = 50, cache_size: int = 2000):
+    server = make_server(source, host, port, directory, shard_size, cache_size)
+    print(f"Serving {directory} at http://{host}:{server.server_port}/ "
+          f"({source.prefix} built on demand, {cache_size} paragraphs cached)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        cache = server.shards.cache
+        print(f"served: {cache.hits} paragraphs from memory, {cache.misses} built", file=sys.stderr)
@@ -0,0 +1,130 @@
+"""Per-stage profiling behind the converters' --profile option.
+
+StageProfiler accumulates, for each named pipeline stage, the number of calls,
+wall time, CPU time of the process and the tracemalloc peak seen while the stage
+was running. Stages may nest (e.g. "diff" inside "unify"); a nested stage's time
+is also part of its parent's. It also keeps the N slowest items (paragraphs,
+<l> elements) with whatever counts the caller attaches, and writes everything as
+one JSON report.
+
+tracemalloc slows allocation-heavy code down noticeably, so with memory tracing
+on, wall and CPU times are best compared between stages of the same run rather
+than with unprofiled runs.
+"""
+import heapq
+import itertools
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator
+
+
+class StageProfiler:
+    def __init__(self, top_n: int = 10, trace_memory: bool = True):
+        self.top_n = top_n
+        self.trace_memory = trace_memory
+        self.stages: Dict[str, Dict] = {}
+        self.slowest = []
+        self._stack = []
+        self._seq = itertools.count()
+        self._started = None
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._started = (time.perf_counter(), time.process_time())
+
+    def stop(self):
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name: str):
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            # The enclosing stage keeps the peak reached so far; this one starts afresh.
+            peak = tracemalloc.get_traced_memory()[1]
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            tracemalloc.reset_peak()
+        frame = [name, 0]
+        self._stack.append(frame)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self._stack.pop()
+            if tracing:
+                frame[1] = max(frame[1], tracemalloc.get_traced_memory()[1])
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], frame[1])
+            entry = self.stages.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_bytes": 0})
+            entry["calls"] += 1
+            entry["wall_s"] += wall
+            entry["cpu_s"] += cpu
+            entry["peak_bytes"] = max(entry["peak_bytes"], frame[1])
+
+    def iterate(self, iterable: Iterable, name: str) -> Iterator:
+        # Times producing each item (e.g. incremental parsing), not the consumer's work on it.
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    @contextmanager
+    def item(self, label: str, info: Dict):
+        # info may still be filled in by the caller inside the with block.
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            record = (time.perf_counter() - start, next(self._seq), label, info)
+            if len(self.slowest) < self.top_n:
+                heapq.heappush(self.slowest, record)
+            elif self.top_n:
+                heapq.heappushpop(self.slowest, record)
+
+    def report(self) -> Dict:
+        total_wall = total_cpu = None
+        if self._started is not None:
+            total_wall = round(time.perf_counter() - self._started[0], 6)
+            total_cpu = round(time.process_time() - self._started[1], 6)
+        return {
+            "trace_memory": self.trace_memory,
+            "total_wall_s": total_wall,
+            "total_cpu_s": total_cpu,
+            "stages": {
+                name: {
+                    "calls": entry["calls"],
+                    "wall_s": round(entry["wall_s"], 6),
+                    "cpu_s": round(entry["cpu_s"], 6),
+                    "peak_bytes": entry["peak_bytes"] if self.trace_memory else None
+                }
+                for name, entry in self.stages.items()
+            },
+            "slowest": [
+                {"label": label, "wall_s": round(wall, 6), **info}
+                for wall, _, label, info in sorted(self.slowest, reverse=True)
+            ]
+        }
+
+    def write(self, path: str) -> Dict:
+        report = self.report()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
+
+    def summary(self) -> str:
+        lines = [f"{'stage':16s} {'calls':>8s} {'wall s':>9s} {'cpu s':>9s} {'peak MB':>9s}"]
+        for name, entry in sorted(self.stages.items(), key=lambda kv: -kv[1]["wall_s"]):
+            peak = f"{entry['peak_bytes'] / 2**20:9.1f}" if self.trace_memory else f"{'-':>9s}"
+            lines.append(f"{name:16s} {entry['calls']:8d} {entry['wall_s']:9.3f} {entry['cpu_s']:9.3f} {peak}")
+        return "\n".join(lines)
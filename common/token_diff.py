@@ -0,0 +1,271 @@
+"""Token diff engines emitting difflib-style (tag, i1, i2, j1, j2) opcodes.
+
+Engines take two sequences of hashable tokens (ideally interned integer ids)
+and return opcodes in the shape of difflib.SequenceMatcher.get_opcodes():
+
+- "difflib": SequenceMatcher with its default autojunk heuristic (the
+  converters' historical behaviour).
+- "difflib-nojunk": SequenceMatcher with autojunk disabled, so frequent
+  tokens are never treated as junk in sequences of 200+ tokens.
+- "myers": Myers' O((N+M)D) shortest edit script. Finds a longest common
+  subsequence, so it never matches fewer tokens than difflib, as long as the
+  script needs at most MYERS_MAX_D edits. Its path trace costs O(D²) time and
+  memory, so a range needing more (an unrelated or rewritten passage) gets
+  difflib's matching blocks instead.
+- "patience": anchors on tokens that occur exactly once in both sequences
+  (longest increasing run of such anchors), recursing into the gaps and
+  falling back to Myers where no anchor exists. Near-linear on prose with
+  long insertions, where D (and so Myers' cost) is large.
+
+CheckedDiff wraps an engine, validates each script and compares it with a
+reference engine (difflib by default).
+"""
+import difflib
+import sys
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+Opcode = Tuple[str, int, int, int, int]
+
+# Edit distance beyond which _myers_blocks gives up and uses difflib's blocks.
+MYERS_MAX_D = 1000
+
+
+def difflib_opcodes(a: Sequence, b: Sequence) -> List[Opcode]:
+    return difflib.SequenceMatcher(None, a, b).get_opcodes()
+
+
+def difflib_nojunk_opcodes(a: Sequence, b: Sequence) -> List[Opcode]:
+    return difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+
+
+def _difflib_blocks(a: Sequence, b: Sequence, a0: int, a1: int, b0: int, b1: int) -> List[Tuple[int, int, int]]:
+    matcher = difflib.SequenceMatcher(None, a[a0:a1], b[b0:b1])
+    return [(a0 + i, b0 + j, size) for i, j, size in matcher.get_matching_blocks() if size]
+
+
+def _myers_blocks(a: Sequence, b: Sequence, a0: int, a1: int, b0: int, b1: int) -> List[Tuple[int, int, int]]:
+    n = a1 - a0
+    m = b1 - b0
+    if n == 0 or m == 0:
+        return []
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    # trace[d] holds the furthest x on each diagonal k in [-d, d] after round d.
+    trace = []
+    for d in range(min(n + m, MYERS_MAX_D) + 1):
+        done = False
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                done = True
+                break
+        trace.append(v[offset - d:offset + d + 1])
+        if done:
+            break
+    else:
+        return _difflib_blocks(a, b, a0, a1, b0, b1)
+
+    blocks = []
+    x, y = n, m
+    for d in range(len(trace) - 1, 0, -1):
+        prev = trace[d - 1]
+        k = x - y
+        if k == -d or (k != d and prev[k - 1 + d - 1] < prev[k + 1 + d - 1]):
+            prev_k = k + 1
+            snake_x = prev[prev_k + d - 1]
+        else:
+            prev_k = k - 1
+            snake_x = prev[prev_k + d - 1] + 1
+        if x > snake_x:
+            blocks.append((a0 + snake_x, b0 + snake_x - k, x - snake_x))
+        x = prev[prev_k + d - 1]
+        y = x - prev_k
+    if x > 0:
+        blocks.append((a0, b0, x))
+    blocks.reverse()
+    return blocks
+
+
+def _trimmed_blocks(a: Sequence, b: Sequence, a0: int, a1: int, b0: int, b1: int, inner) -> List[Tuple[int, int, int]]:
+    # Match the common prefix and suffix directly and leave the middle to inner().
+    lo = 0
+    while a0 + lo < a1 and b0 + lo < b1 and a[a0 + lo] == b[b0 + lo]:
+        lo += 1
+    hi = 0
+    while a1 - hi > a0 + lo and b1 - hi > b0 + lo and a[a1 - hi - 1] == b[b1 - hi - 1]:
+        hi += 1
+    raw = []
+    if lo:
+        raw.append((a0, b0, lo))
+    raw.extend(inner(a, b, a0 + lo, a1 - hi, b0 + lo, b1 - hi))
+    if hi:
+        raw.append((a1 - hi, b1 - hi, hi))
+    return raw
+
+
+def _unique_anchors(a: Sequence, b: Sequence, a0: int, a1: int, b0: int, b1: int) -> List[Tuple[int, int]]:
+    # Tokens occurring once on each side, reduced to their longest run increasing in both.
+    seen_a = {}
+    for i in range(a0, a1):
+        seen_a[a[i]] = -1 if a[i] in seen_a else i
+    seen_b = {}
+    for j in range(b0, b1):
+        tok = b[j]
+        if seen_a.get(tok, -1) >= 0:
+            seen_b[tok] = -1 if tok in seen_b else j
+    pairs = sorted((seen_a[tok], j) for tok, j in seen_b.items() if j >= 0)
+    tails = []
+    tail_idx = []
+    back = []
+    for idx, (_, j) in enumerate(pairs):
+        pos = bisect_left(tails, j)
+        back.append(tail_idx[pos - 1] if pos else -1)
+        if pos == len(tails):
+            tails.append(j)
+            tail_idx.append(idx)
+        else:
+            tails[pos] = j
+            tail_idx[pos] = idx
+    anchors = []
+    idx = tail_idx[-1] if tail_idx else -1
+    while idx >= 0:
+        anchors.append(pairs[idx])
+        idx = back[idx]
+    anchors.reverse()
+    return anchors
+
+
+def _patience_blocks(a: Sequence, b: Sequence, a0: int, a1: int, b0: int, b1: int) -> List[Tuple[int, int, int]]:
+    if a0 == a1 or b0 == b1:
+        return []
+    anchors = _unique_anchors(a, b, a0, a1, b0, b1)
+    if not anchors:
+        return _myers_blocks(a, b, a0, a1, b0, b1)
+    blocks = []
+    i, j = a0, b0
+    for ai, bj in anchors:
+        blocks.extend(_trimmed_blocks(a, b, i, ai, j, bj, _patience_blocks))
+        blocks.append((ai, bj, 1))
+        i, j = ai + 1, bj + 1
+    blocks.extend(_trimmed_blocks(a, b, i, a1, j, b1, _patience_blocks))
+    return blocks
+
+
+def _finish_blocks(raw: List[Tuple[int, int, int]], n: int, m: int) -> List[Tuple[int, int, int]]:
+    # Merge adjacent blocks and end with difflib's (n, m, 0) sentinel.
+    blocks = []
+    for i, j, size in raw:
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+            pi, pj, psize = blocks[-1]
+            blocks[-1] = (pi, pj, psize + size)
+        else:
+            blocks.append((i, j, size))
+    blocks.append((n, m, 0))
+    return blocks
+
+
+def myers_matching_blocks(a: Sequence, b: Sequence) -> List[Tuple[int, int, int]]:
+    return _finish_blocks(_trimmed_blocks(a, b, 0, len(a), 0, len(b), _myers_blocks), len(a), len(b))
+
+
+def patience_matching_blocks(a: Sequence, b: Sequence) -> List[Tuple[int, int, int]]:
+    return _finish_blocks(_trimmed_blocks(a, b, 0, len(a), 0, len(b), _patience_blocks), len(a), len(b))
+
+
+def opcodes_from_blocks(blocks: List[Tuple[int, int, int]]) -> List[Opcode]:
+    # Same construction as difflib.SequenceMatcher.get_opcodes().
+    i = j = 0
+    opcodes = []
+    for ai, bj, size in blocks:
+        tag = ""
+        if i < ai and j < bj:
+            tag = "replace"
+        elif i < ai:
+            tag = "delete"
+        elif j < bj:
+            tag = "insert"
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(("equal", ai, i, bj, j))
+    return opcodes
+
+
+def myers_opcodes(a: Sequence, b: Sequence) -> List[Opcode]:
+    return opcodes_from_blocks(myers_matching_blocks(a, b))
+
+
+def patience_opcodes(a: Sequence, b: Sequence) -> List[Opcode]:
+    return opcodes_from_blocks(patience_matching_blocks(a, b))
+
+
+ENGINES: Dict[str, Callable[[Sequence, Sequence], List[Opcode]]] = {
+    "difflib": difflib_opcodes,
+    "difflib-nojunk": difflib_nojunk_opcodes,
+    "myers": myers_opcodes,
+    "patience": patience_opcodes,
+}
+
+
+def validate_opcodes(a: Sequence, b: Sequence, opcodes: List[Opcode]) -> None:
+    """Raise ValueError unless opcodes cover a and b contiguously and turn a into b."""
+    i = j = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        if i1 != i or j1 != j or i2 < i1 or j2 < j1:
+            raise ValueError(f"non-contiguous opcode {(tag, i1, i2, j1, j2)}")
+        if tag == "equal" and (i2 - i1 != j2 - j1 or list(a[i1:i2]) != list(b[j1:j2])):
+            raise ValueError(f"'equal' opcode over different tokens {(tag, i1, i2, j1, j2)}")
+        if tag == "delete" and j2 != j1 or tag == "insert" and i2 != i1:
+            raise ValueError(f"malformed opcode {(tag, i1, i2, j1, j2)}")
+        i, j = i2, j2
+    if i != len(a) or j != len(b):
+        raise ValueError("opcodes do not cover both sequences")
+
+
+def matched_tokens(opcodes: List[Opcode]) -> int:
+    return sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag == "equal")
+
+
+class CheckedDiff:
+    """Run an engine, validate its scripts and tally differences against a reference engine."""
+
+    def __init__(self, name: str, reference: str = "difflib"):
+        self.name = name
+        self.engine = ENGINES[name]
+        self.reference = ENGINES[reference]
+        self.reference_name = reference
+        self.calls = 0
+        self.identical = 0
+        self.matched = 0
+        self.reference_matched = 0
+
+    def __call__(self, a: Sequence, b: Sequence) -> List[Opcode]:
+        opcodes = self.engine(a, b)
+        validate_opcodes(a, b, opcodes)
+        reference = self.reference(a, b)
+        self.calls += 1
+        self.identical += opcodes == reference
+        self.matched += matched_tokens(opcodes)
+        self.reference_matched += matched_tokens(reference)
+        return opcodes
+
+    def report(self, out=sys.stderr) -> None:
+        print(f"diff check: {self.name} vs {self.reference_name}: {self.calls} diffs, "
+              f"{self.identical} identical, all scripts valid; matched tokens "
+              f"{self.matched} vs {self.reference_matched}", file=out)
+
+
+def get_diff_engine(name: str, check: bool = False) -> Callable[[Sequence, Sequence], List[Opcode]]:
+    if name not in ENGINES:
+        raise ValueError(f"unknown diff engine {name!r} (choose from {', '.join(ENGINES)})")
+    return CheckedDiff(name) if check else ENGINES[name]
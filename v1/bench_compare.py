@@ -0,0 +1,245 @@
+"""Stage benchmark for compare_with_notes_aligned.py.
+
+Times load, align, unify, notes and serialize on the edition files and on
+synthetic corpora built by replicating them, and writes the timings as JSON so
+runs from different commits can be compared:
+
+    python bench_compare.py --scales 1 10 --out bench-v1.json
+    python bench_compare.py --scales 1 10 --out bench-v1-new.json --baseline bench-v1.json
+
+A synthetic corpus of scale N holds N copies of each edition's body. In copy k,
+about one word in eight is suffixed with k, and end note numbers are suffixed too.
+A word changes the same way in every edition, so the copies align like the
+original text.
+
+Every run executes in a fresh interpreter, so memo caches start empty and
+max_rss_kb is the peak of that run alone rather than of the whole benchmark.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from copy import deepcopy
+from datetime import datetime, timezone
+from pathlib import Path
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from lxml import etree
+
+from compare_with_notes_aligned import FinalAnalyzerWithAlignedNotes, bounded_levenshtein, find_edition_files
+from common.token_diff import ENGINES
+
+STAGES = ('load', 'align', 'unify', 'notes', 'serialize')
+WORD_RE = re.compile(r'\w+')
+
+def mutate_words(text, copy):
+    """Suffix about one word in eight with the copy number, the same words in every edition"""
+    if not text or not copy:
+        return text
+    def mutate(match):
+        word = match.group()
+        if zlib.crc32(f'{copy}:{word}'.encode('utf-8')) % 8 == 0:
+            return f'{word}{copy}'
+        return word
+    return WORD_RE.sub(mutate, text)
+
+def write_scaled_tei(src, dst, scale):
+    """Write src with its body replicated scale times, copies mutated by mutate_words"""
+    parser = etree.XMLParser(recover=True, resolve_entities=False)
+    tree = etree.parse(src, parser)
+    body = tree.find('.//body')
+    originals = list(body)
+    for copy in range(1, scale):
+        for child in originals:
+            clone = deepcopy(child)
+            for elem in clone.iter():
+                if not isinstance(elem.tag, str):
+                    continue
+                if elem.tag == 'note' and elem.get('n'):
+                    elem.set('n', f"{elem.get('n')}-{copy}")
+                elem.text = mutate_words(elem.text, copy)
+                elem.tail = mutate_words(elem.tail, copy)
+            body.append(clone)
+    tree.write(dst, encoding='utf-8', xml_declaration=True)
+
+@contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def bench_corpus(files, stream=False, diff_engine='difflib', align='greedy'):
+    """Run the analysis stage by stage on files ({year: path}) and return the timings"""
+    # Repeats and scales must not reuse edit distances memoized by an earlier run
+    bounded_levenshtein.cache_clear()
+    analyzer = FinalAnalyzerWithAlignedNotes(diff_engine)
+    timings = {}
+    with redirect_stdout(io.StringIO()):
+        with timed(timings, 'load'):
+            for year, path in files.items():
+                if stream:
+                    analyzer.load_tei_streaming(path, year)
+                else:
+                    analyzer.load_tei(path, year)
+
+        with timed(timings, 'align'):
+            if align == 'banded':
+                alignments = analyzer.align_paragraphs_banded()
+            else:
+                alignments = analyzer.align_paragraphs()
+
+        unified_texts = []
+        variant_stats = dict.fromkeys(('orthographic', 'lexical', 'substitution', 'addition', 'deletion'), 0)
+        with timed(timings, 'unify'):
+            for alignment in alignments:
+                unified = analyzer.build_unified_text(
+                    alignment.get('1808'),
+                    alignment.get('1826'),
+                    alignment.get('1849')
+                )
+                for category, count in analyzer.count_variants(unified).items():
+                    variant_stats[category] += count
+                unified_texts.append(unified)
+
+        with timed(timings, 'notes'):
+            work_units = [analyzer.prepare_work_unit(alignment) for alignment in alignments]
+            analyzer.find_moved_notes(work_units)
+            notes = [analyzer.build_notes(*unit) for unit in work_units]
+
+        with timed(timings, 'serialize'):
+            results = [
+                analyzer.make_result(alignment, unified, *paragraph_notes)
+                for alignment, unified, paragraph_notes in zip(alignments, unified_texts, notes)
+            ]
+            del unified_texts, notes
+            # Encoded like analyze() writes it, into a sink rather than one large string
+            with open(os.devnull, 'w', encoding='utf-8') as sink:
+                json.dump(analyzer.make_output(results, variant_stats), sink, ensure_ascii=False, indent=2)
+
+    return {
+        'paragraphs': len(alignments),
+        'stages': {stage: round(timings[stage], 4) for stage in STAGES},
+        'total': round(sum(timings.values()), 4),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+def run_isolated(func, *args):
+    """Call func(*args) in a freshly spawned interpreter and return its result"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+def git_revision():
+    """Return (commit, dirty) for the checkout this script lives in, or (None, None)"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=cwd, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+def compare_runs(baseline, report, threshold):
+    """Print stage timings against a baseline report; return the number of regressions"""
+    old_runs = {run['scale']: run for run in baseline['runs']}
+    regressions = 0
+    print(f"\nAgainst {baseline.get('commit') or 'baseline'} (regression: > {threshold:.0%} slower)")
+    for run in report['runs']:
+        old = old_runs.get(run['scale'])
+        if old is None:
+            continue
+        for stage in STAGES + ('total',):
+            before = old['stages'].get(stage) if stage != 'total' else old['total']
+            after = run['stages'][stage] if stage != 'total' else run['total']
+            if not before:
+                continue
+            ratio = after / before
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print(f"  {run['scale']:>4}x {stage:10s} {before:9.3f}s -> {after:9.3f}s  {ratio:5.2f}x{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of compare_with_notes_aligned.py')
+    parser.add_argument('--data-dir', default=str(Path(__file__).resolve().parent.parent),
+                        help='directory with the edition TEI files (default: the repository root)')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10], metavar='N',
+                        help='corpus sizes as multiples of the edition files (default: 1 10)')
+    parser.add_argument('--repeat', type=int, default=1, metavar='N',
+                        help='runs per scale; the fastest total is kept (default: 1)')
+    parser.add_argument('--stream', action='store_true', help='load with the iterparse loader')
+    parser.add_argument('--diff-engine', choices=list(ENGINES), default='difflib',
+                        help='token diff engine (default: difflib)')
+    parser.add_argument('--align', choices=['greedy', 'banded'], default='greedy',
+                        help='paragraph alignment (default: greedy)')
+    parser.add_argument('--out', default='bench-v1.json', metavar='PATH',
+                        help='write the JSON report to PATH (default: bench-v1.json)')
+    parser.add_argument('--baseline', metavar='PATH', help='compare with an earlier JSON report')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown counted as a regression (default: 0.1, i.e. 10%%)')
+    args = parser.parse_args()
+
+    files = find_edition_files(args.data_dir)
+    if not files:
+        parser.error(f'no edition TEI files in {args.data_dir}')
+
+    commit, dirty = git_revision()
+    report = {
+        'tool': 'compare_with_notes_aligned',
+        'commit': commit,
+        'dirty': dirty,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'stream': args.stream,
+        'diff_engine': args.diff_engine,
+        'align': args.align,
+        'runs': []
+    }
+
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            scaled = files
+            if scale > 1:
+                scaled = {}
+                for year, path in files.items():
+                    scaled[year] = os.path.join(tmp, f'{year}.xml')
+                    write_scaled_tei(path, scaled[year], scale)
+            runs = [
+                run_isolated(bench_corpus, scaled, args.stream, args.diff_engine, args.align)
+                for _ in range(args.repeat)
+            ]
+        run = min(runs, key=lambda r: r['total'])
+        run = {'scale': scale, **run}
+        report['runs'].append(run)
+        stages = '  '.join(f"{stage} {run['stages'][stage]:.3f}s" for stage in STAGES)
+        print(f"{scale:>4}x  {run['paragraphs']:6d} paragraphs  {stages}  total {run['total']:.3f}s")
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {args.out}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare_runs(baseline, report, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,113 +1,415 @@
 from lxml import etree
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext, redirect_stdout
+from functools import lru_cache
+import argparse
 import json
+import os
 from pathlib import Path
-import difflib
 import re
+import sys
+import time
 
-class FinalAnalyzerWithAlignedNotes:
+# token_diff, stage_profile and slot_server are shared with v2 and live in ../common
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+try:
+    from common import slot_server
+    from common.stage_profile import StageProfiler
+    from common.token_diff import ENGINES, MYERS_MAX_D, get_diff_engine
+except ImportError as exc:
+    sys.exit(f'compare_with_notes_aligned.py needs the common/ directory next to v1/ ({exc})')
+from note_lsh import LSHIndex, MinHasher
+
+TOKEN_RE = re.compile(r'\S+')
+
+# Segment edition sets are bitmasks over EDITIONS; EDITION_LISTS maps a mask back to the
+# chronological list written to JSON, and a token's colour is that of its earliest edition.
+EDITIONS = ('1808', '1826', '1849')
+EDITION_BITS = {year: 1 << i for i, year in enumerate(EDITIONS)}
+EDITION_LISTS = [[year for year in EDITIONS if mask & EDITION_BITS[year]] for mask in range(1 << len(EDITIONS))]
+EDITION_COLORS = ('blue', 'red', 'black')
+
+SEGMENT_TYPES = [
+    'original', 'replaced', 'replacement', 'new_in_1826', 'new_in_1849',
+    'added_1826', 'deleted_1826', 'added_1849', 'deleted_1849'
+]
+TYPE_CODES = {name: code for code, name in enumerate(SEGMENT_TYPES)}
+BIT_1808, BIT_1826, BIT_1849 = (EDITION_BITS[year] for year in EDITIONS)
+
+@lru_cache(maxsize=65536)
+def bounded_levenshtein(s1, s2, max_dist):
+    """Edit distance between s1 and s2, or max_dist + 1 as soon as it must exceed max_dist"""
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    len1 = len(s1)
+    len2 = len(s2)
+    over = max_dist + 1
+    if len1 - len2 > max_dist:
+        return over
+    if len2 == 0:
+        return len1
+    
+    # Only cells within max_dist of the diagonal can stay within the bound
+    previous_row = [j if j <= max_dist else over for j in range(len2 + 1)]
+    for i in range(1, len1 + 1):
+        c1 = s1[i - 1]
+        lo = max(1, i - max_dist)
+        hi = min(len2, i + max_dist)
+        current_row = [over] * (len2 + 1)
+        if lo == 1 and i <= max_dist:
+            current_row[0] = i
+        row_min = current_row[0]
+        for j in range(lo, hi + 1):
+            value = min(
+                previous_row[j] + 1,
+                current_row[j - 1] + 1,
+                previous_row[j - 1] + (c1 != s2[j - 1])
+            )
+            if value > over:
+                value = over
+            current_row[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_dist:
+            return over
+        previous_row = current_row
+    
+    return previous_row[len2]
+
+class TokenVocabulary:
+    """Maps token strings to compact integer ids shared by all editions"""
+    __slots__ = ('ids', 'tokens')
+    
     def __init__(self):
+        self.ids = {}
+        self.tokens = []
+    
+    def intern(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.ids[token] = token_id
+            self.tokens.append(sys.intern(token))
+        return token_id
+
+class TokenizedText:
+    """Text tokenized once: token ids, lowercase token set and token offsets"""
+    __slots__ = ('text', 'token_ids', 'token_set', 'token_starts', 'token_ends')
+    
+    def __init__(self, text, vocabulary):
+        self.text = text
+        self.token_ids = array('I')
+        self.token_starts = array('I')
+        self.token_ends = array('I')
+        for match in TOKEN_RE.finditer(text):
+            self.token_ids.append(vocabulary.intern(match.group()))
+            self.token_starts.append(match.start())
+            self.token_ends.append(match.end())
+        self.token_set = frozenset(sys.intern(t) for t in TOKEN_RE.findall(text.lower()))
+    
+    @property
+    def tokens(self):
+        text = self.text
+        return [text[start:end] for start, end in zip(self.token_starts, self.token_ends)]
+
+class Paragraph(TokenizedText):
+    """A paragraph of one edition with its end note markers as (position, n) pairs"""
+    __slots__ = ('note_markers',)
+    
+    def __init__(self, text, vocabulary, note_markers=()):
+        super().__init__(text, vocabulary)
+        self.note_markers = note_markers
+    
+    @classmethod
+    def joined(cls, paragraphs, vocabulary):
+        """One paragraph for consecutive paragraphs aligned as a whole, note markers shifted"""
+        if len(paragraphs) == 1:
+            return paragraphs[0]
+        note_markers = []
+        offset = 0
+        for para in paragraphs:
+            note_markers.extend((position + offset, n) for position, n in para.note_markers)
+            offset += len(para.text) + 1
+        return cls(' '.join(para.text for para in paragraphs), vocabulary, note_markers)
+
+class Note(TokenizedText):
+    """An end note resolved from a marker inside a paragraph"""
+    __slots__ = ('n', 'position', 'content_html', 'year')
+    
+    def __init__(self, n, position, content_html, plain_text, year, vocabulary):
+        super().__init__(plain_text, vocabulary)
+        self.n = n
+        self.position = position
+        self.content_html = content_html
+        self.year = year
+    
+    @property
+    def plain_text(self):
+        return self.text
+
+class Segment:
+    """A unified-text segment with an edition bitmask and an interned type code"""
+    __slots__ = ('text', 'editions', 'kind', 'category', 'replaced_by')
+    
+    def __init__(self, text, editions, kind, category=None, replaced_by=None):
+        self.text = text
+        self.editions = editions
+        self.kind = kind
+        self.category = category
+        self.replaced_by = replaced_by
+    
+    @property
+    def type(self):
+        return SEGMENT_TYPES[self.kind]
+    
+    def to_json(self):
+        editions = self.editions
+        data = {
+            'text': self.text,
+            'color': EDITION_COLORS[(editions & -editions).bit_length() - 1],
+            'editions': EDITION_LISTS[editions],
+            'type': SEGMENT_TYPES[self.kind]
+        }
+        if self.replaced_by is not None:
+            data['replaced_by'] = self.replaced_by
+        data['category'] = self.category
+        return data
+
+def segments_to_json(segments):
+    return [seg.to_json() for seg in segments]
+
+class FinalAnalyzerWithAlignedNotes:
+    def __init__(self, diff_engine='difflib', check_diff=False, profiler=None):
         self.editions = {}
-        self.edition_trees = {}
+        self.end_notes = {}
+        self.vocabulary = TokenVocabulary()
+        self.diff_engine = diff_engine
+        self.diff_opcodes = get_diff_engine(diff_engine, check_diff)
+        self.diff_report = getattr(self.diff_opcodes, 'report', None)
+        self.profiler = profiler
+        if profiler is not None:
+            diff_opcodes = self.diff_opcodes
+            def profiled_diff(a, b):
+                with profiler.stage('diff'):
+                    return diff_opcodes(a, b)
+            self.diff_opcodes = profiled_diff
+    
+    def stage(self, name):
+        """Context manager timing a pipeline stage when profiling"""
+        return self.profiler.stage(name) if self.profiler is not None else nullcontext()
     
     def load_tei(self, filepath, year):
         print(f"Loading {year}...")
         try:
             parser = etree.XMLParser(recover=True, resolve_entities=False)
             tree = etree.parse(filepath, parser)
-            self.edition_trees[year] = tree
         except Exception as e:
             print(f"  Error: {e}")
             return []
         
         paragraphs = []
         for p in tree.xpath('//body//p'):
-            text = ' '.join(p.itertext()).strip()
-            if text and len(text) > 20:
-                paragraphs.append({
-                    'text': text,
-                    'element': p
-                })
+            paragraph = self.make_paragraph(p)
+            if paragraph:
+                paragraphs.append(paragraph)
         
         if not paragraphs:
             for p in tree.xpath('//div//p'):
-                text = ' '.join(p.itertext()).strip()
-                if text and len(text) > 20:
-                    paragraphs.append({
-                        'text': text,
-                        'element': p
-                    })
+                paragraph = self.make_paragraph(p)
+                if paragraph:
+                    paragraphs.append(paragraph)
         
         print(f"  Found {len(paragraphs)} paragraphs")
         self.editions[year] = paragraphs
+        with self.stage('note index'):
+            self.end_notes[year] = self.index_end_notes(tree)
         return paragraphs
     
-    def extract_note_positions_from_paragraph(self, para_element, year):
-        """Extract notes and their positions in the paragraph text"""
-        if para_element is None:
+    def load_tei_streaming(self, filepath, year):
+        """Load paragraphs and end notes with iterparse, discarding elements once consumed"""
+        print(f"Loading {year} (streaming)...")
+        body_paragraphs = []
+        div_paragraphs = []
+        end_notes = {}
+        open_slots = []
+        open_body = 0
+        open_div = 0
+        open_p = 0
+        open_note = 0
+        
+        try:
+            context = etree.iterparse(filepath, events=('start', 'end'),
+                                      recover=True, resolve_entities=False)
+            for event, elem in context:
+                tag = elem.tag
+                if event == 'start':
+                    if tag == 'body':
+                        open_body += 1
+                    elif tag == 'div':
+                        open_div += 1
+                    elif tag == 'note':
+                        open_note += 1
+                    elif tag == 'p':
+                        open_p += 1
+                        # Reserve slots at the start tag so nested paragraphs keep document order
+                        body_slot = div_slot = None
+                        if open_body:
+                            body_slot = len(body_paragraphs)
+                            body_paragraphs.append(None)
+                        if open_div:
+                            div_slot = len(div_paragraphs)
+                            div_paragraphs.append(None)
+                        open_slots.append((body_slot, div_slot))
+                    continue
+                
+                if tag == 'body':
+                    open_body -= 1
+                elif tag == 'div':
+                    open_div -= 1
+                elif tag == 'note':
+                    open_note -= 1
+                    self.index_end_note(end_notes, elem)
+                elif tag == 'p':
+                    open_p -= 1
+                    body_slot, div_slot = open_slots.pop()
+                    paragraph = self.make_paragraph(elem)
+                    if body_slot is not None:
+                        body_paragraphs[body_slot] = paragraph
+                    if div_slot is not None:
+                        div_paragraphs[div_slot] = paragraph
+                
+                # Enclosing paragraphs and notes still need their subtree
+                if not open_p and not open_note:
+                    elem.clear()
+                    parent = elem.getparent()
+                    if parent is not None:
+                        while elem.getprevious() is not None:
+                            del parent[0]
+            del context
+        except Exception as e:
+            print(f"  Error: {e}")
             return []
         
-        root = self.edition_trees[year].getroot()
-        notes_with_positions = []
+        paragraphs = [p for p in body_paragraphs if p]
+        if not paragraphs:
+            paragraphs = [p for p in div_paragraphs if p]
         
-        text_parts = []
-        note_markers = []
+        print(f"  Found {len(paragraphs)} paragraphs")
+        self.editions[year] = paragraphs
+        self.end_notes[year] = end_notes
+        return paragraphs
+    
+    def load_volumes(self, filepaths, year, stream=False):
+        """Load the volumes of one edition, in the given order, as a single witness
+        
+        Note numbers restart in every volume, so from the second volume on note markers and
+        end notes are renumbered with the volume as prefix (n "17" of volume 2 becomes "2:17").
+        """
+        load = self.load_tei_streaming if stream else self.load_tei
+        paragraphs = []
+        end_notes = {}
+        for volume, filepath in enumerate(filepaths, 1):
+            volume_paragraphs = load(filepath, year)
+            volume_notes = self.end_notes.get(year, {})
+            if volume > 1:
+                prefix = f'{volume}:'
+                for para in volume_paragraphs:
+                    para.note_markers = [(position, prefix + n) for position, n in para.note_markers]
+                volume_notes = {prefix + n: note for n, note in volume_notes.items()}
+            paragraphs.extend(volume_paragraphs)
+            end_notes.update(volume_notes)
+        self.editions[year] = paragraphs
+        self.end_notes[year] = end_notes
+        return paragraphs
+    
+    def make_paragraph(self, para_element):
+        """Build a Paragraph record, or None if the paragraph is too short to align"""
+        with self.stage('note markers'):
+            text, note_markers = self.extract_text_and_note_markers(para_element)
+        if text and len(text) > 20:
+            return Paragraph(text, self.vocabulary, note_markers)
+        return None
+    
+    def index_end_notes(self, tree):
+        """Index end note content by n, pre-rendering plain text and HTML"""
+        end_notes = {}
+        for note_elem in tree.getroot().iter('note'):
+            self.index_end_note(end_notes, note_elem)
+        return end_notes
+    
+    def index_end_note(self, end_notes, note_elem):
+        """Add note_elem to end_notes if it is an end note with content not indexed yet"""
+        if note_elem.get('place') != 'end':
+            return
+        n = note_elem.get('n')
+        # Markers are empty notes; the first note with content wins
+        if n is None or n in end_notes or (note_elem.text is None and len(note_elem) == 0):
+            return
+        end_notes[n] = {
+            'plain_text': ' '.join(note_elem.itertext()).strip(),
+            'content_html': ''.join(
+                etree.tostring(child, encoding='unicode', method='html')
+                for child in note_elem
+            )
+        }
+    
+    def extract_text_and_note_markers(self, para_element):
+        """Paragraph text (its text chunks joined by spaces, stripped) and its end note markers
+        
+        A marker's position is the offset in that text right after the text preceding the
+        marker, so it lives in the same offset space as the paragraph's token starts.
+        """
+        chunks = []
+        marker_chunks = []
         
-        def extract_text_with_markers(elem, current_pos=0):
+        def walk(elem):
             if elem.text:
-                text_parts.append(elem.text)
-                current_pos += len(elem.text)
-            
+                chunks.append(elem.text)
             for child in elem:
-                if child.tag.endswith('note') and child.get('place') == 'end' and not child.text and len(child) == 0:
-                    n = child.get('n', '').strip()
-                    if n:
-                        note_markers.append({
-                            'position': current_pos,
-                            'n': n
-                        })
-                
-                current_pos = extract_text_with_markers(child, current_pos)
-                
+                if isinstance(child.tag, str):
+                    if child.tag.endswith('note') and child.get('place') == 'end' and not child.text and len(child) == 0:
+                        n = child.get('n', '').strip()
+                        if n:
+                            marker_chunks.append((len(chunks), n))
+                    walk(child)
                 if child.tail:
-                    text_parts.append(child.tail)
-                    current_pos += len(child.tail)
-            
-            return current_pos
+                    chunks.append(child.tail)
         
-        extract_text_with_markers(para_element)
-        full_text = ''.join(text_parts)
+        walk(para_element)
+        joined = ' '.join(chunks)
+        text = joined.strip()
+        lead = len(joined) - len(joined.lstrip())
         
-        for marker in note_markers:
-            n = marker['n']
-            xpath = f'.//note[@place="end" and @n="{n}" and node()]'
-            note_content_list = root.xpath(xpath)
-            
-            if note_content_list:
-                note_elem = note_content_list[0]
-                plain_text = ' '.join(note_elem.itertext()).strip()
-                content_parts = []
-                for child in note_elem:
-                    content_parts.append(etree.tostring(child, encoding='unicode', method='html'))
-                
-                notes_with_positions.append({
-                    'n': n,
-                    'position': marker['position'],
-                    'content_html': ''.join(content_parts),
-                    'plain_text': plain_text,
-                    'year': year
-                })
+        # Offset in the joined text where each chunk ends
+        chunk_ends = []
+        offset = -1
+        for chunk in chunks:
+            offset += len(chunk) + 1
+            chunk_ends.append(offset)
         
-        return notes_with_positions
-    
-    def tokenize(self, text):
-        """Tokenize preserving punctuation"""
-        return re.findall(r'\S+', text)
+        note_markers = []
+        for count, n in marker_chunks:
+            position = chunk_ends[count - 1] - lead if count else 0
+            note_markers.append((min(max(position, 0), len(text)), n))
+        return text, note_markers
     
-    def similarity_ratio(self, text1, text2):
-        """Calculate similarity between two texts"""
-        tokens1 = set(self.tokenize(text1.lower()))
-        tokens2 = set(self.tokenize(text2.lower()))
+    def lookup_note_markers(self, note_markers, year):
+        """Look up (n, position, content_html, plain_text) for each resolvable note marker"""
+        end_notes = self.end_notes.get(year, {})
+        note_data = []
         
+        for position, n in note_markers:
+            end_note = end_notes.get(n)
+            
+            if end_note:
+                note_data.append((n, position, end_note['content_html'], end_note['plain_text']))
+        
+        return note_data
+    
+    def token_similarity(self, tokens1, tokens2):
+        """Calculate Jaccard similarity between two lowercase token sets"""
         if not tokens1 or not tokens2:
             return 0.0
         
@@ -116,24 +418,12 @@ class FinalAnalyzerWithAlignedNotes:
         
         return len(intersection) / len(union) if union else 0.0
     
-    def levenshtein_distance(self, s1, s2):
-        """Calculate edit distance between two strings"""
-        if len(s1) < len(s2):
-            return self.levenshtein_distance(s2, s1)
-        if len(s2) == 0:
-            return len(s1)
-        
-        previous_row = range(len(s2) + 1)
-        for i, c1 in enumerate(s1):
-            current_row = [i + 1]
-            for j, c2 in enumerate(s2):
-                insertions = previous_row[j + 1] + 1
-                deletions = current_row[j] + 1
-                substitutions = previous_row[j] + (c1 != c2)
-                current_row.append(min(insertions, deletions, substitutions))
-            previous_row = current_row
-        
-        return previous_row[-1]
+    def orthographic_distance_limit(self, max_len):
+        """Largest edit distance still counted as orthographic: <= 2 or below 30% of max_len"""
+        limit = int(max_len * 0.3) + 1
+        while limit > 2 and not limit / max_len < 0.3:
+            limit -= 1
+        return max(limit, 2)
     
     def classify_variant(self, text1, text2, change_type):
         """Classify variant into categories"""
@@ -149,10 +439,11 @@ class FinalAnalyzerWithAlignedNotes:
             words2 = text2.split()
             
             if len(words1) == 1 and len(words2) == 1:
-                dist = self.levenshtein_distance(text1.lower(), text2.lower())
                 max_len = max(len(text1), len(text2))
+                max_dist = self.orthographic_distance_limit(max_len)
+                dist = bounded_levenshtein(text1.lower(), text2.lower(), max_dist)
                 
-                if dist <= 2 or (max_len > 0 and dist / max_len < 0.3):
+                if dist <= max_dist:
                     return 'orthographic'
                 else:
                     return 'lexical'
@@ -184,7 +475,7 @@ class FinalAnalyzerWithAlignedNotes:
                 for idx, note_1826 in enumerate(notes_1826):
                     if idx in used_1826:
                         continue
-                    score = self.similarity_ratio(note_1808['plain_text'], note_1826['plain_text'])
+                    score = self.token_similarity(note_1808.token_set, note_1826.token_set)
                     if score > best_score:
                         best_score = score
                         best_match = (idx, note_1826)
@@ -202,7 +493,7 @@ class FinalAnalyzerWithAlignedNotes:
                 for idx, note_1849 in enumerate(notes_1849):
                     if idx in used_1849:
                         continue
-                    score = self.similarity_ratio(note_1808['plain_text'], note_1849['plain_text'])
+                    score = self.token_similarity(note_1808.token_set, note_1849.token_set)
                     if score > best_score:
                         best_score = score
                         best_match = (idx, note_1849)
@@ -232,7 +523,7 @@ class FinalAnalyzerWithAlignedNotes:
                     for idx49, note_1849 in enumerate(notes_1849):
                         if idx49 in used_1849:
                             continue
-                        score = self.similarity_ratio(note_1826['plain_text'], note_1849['plain_text'])
+                        score = self.token_similarity(note_1826.token_set, note_1849.token_set)
                         if score > best_score:
                             best_score = score
                             best_match = (idx49, note_1849)
@@ -257,175 +548,204 @@ class FinalAnalyzerWithAlignedNotes:
         
         return alignments
     
+    def note_key(self, note_alignment):
+        """(year, n) of the earliest edition present in a note alignment"""
+        return next((year, note_alignment[year].n) for year in EDITIONS if note_alignment[year])
+    
+    def find_moved_notes(self, work_units, threshold=0.3):
+        """Match notes new in their paragraph with notes missing from another paragraph
+        
+        align_notes only compares the notes of one paragraph alignment; its results come
+        with the work units from prepare_work_unit. Here every note reported as new in
+        1826 or 1849 is compared with the notes of all other paragraphs that lack that
+        edition, using MinHash/LSH candidates verified by token Jaccard. The best pairs
+        win, each note moving at most once. The moves are stored under 'note_moves' in
+        the alignments of both paragraphs for build_notes.
+        """
+        hasher = MinHasher()
+        signatures = {}
+        
+        def signature(note):
+            if note.text not in signatures:
+                signatures[note.text] = hasher.signature(note.text)
+            return signatures[note.text]
+        
+        orphans = []
+        for alignment, _, aligned_notes in work_units:
+            for note_alignment in aligned_notes:
+                if not all(note_alignment[year] for year in EDITIONS):
+                    orphans.append((alignment['index'], note_alignment))
+        
+        moved = set()
+        moves = []
+        for year in ('1826', '1849'):
+            earlier = EDITIONS[:EDITIONS.index(year)]
+            index = LSHIndex()
+            sources = {}
+            for k, (_, note_alignment) in enumerate(orphans):
+                if note_alignment[year] or k in moved:
+                    continue
+                # Compared with the latest earlier text, as in build_note_unified_text
+                base = next((note_alignment[y] for y in reversed(earlier) if note_alignment[y]), None)
+                sig = signature(base) if base else None
+                if sig is not None:
+                    sources[k] = base
+                    index.add(k, sig)
+            
+            pairs = []
+            for t, (para_index, note_alignment) in enumerate(orphans):
+                if not note_alignment.get(f'new_in_{year}') or t in moved:
+                    continue
+                if not note_alignment['1849']:
+                    # build_note_unified_text keeps only the 1808 text of notes missing from 1849
+                    continue
+                sig = signature(note_alignment[year])
+                if sig is None:
+                    continue
+                for k in index.candidates(sig):
+                    if orphans[k][0] == para_index:
+                        continue
+                    score = self.token_similarity(sources[k].token_set, note_alignment[year].token_set)
+                    if score > threshold:
+                        pairs.append((-score, k, t))
+            
+            for score, k, t in sorted(pairs):
+                if k in moved or t in moved:
+                    continue
+                moved.update((k, t))
+                moves.append((k, t, year, -score))
+        
+        by_index = {alignment['index']: alignment for alignment, _, _ in work_units}
+        for k, t, year, score in moves:
+            source_index, source = orphans[k]
+            target_index, target = orphans[t]
+            source_notes = {
+                y: source[y] for y in EDITIONS[:EDITIONS.index(year)] if source[y]
+            }
+            target_moves = by_index[target_index].setdefault('note_moves', {'from': {}, 'to': {}})
+            target_moves['from'][self.note_key(target)] = {
+                'index': source_index,
+                'notes': source_notes,
+                'score': score
+            }
+            source_moves = by_index[source_index].setdefault('note_moves', {'from': {}, 'to': {}})
+            source_moves['to'][self.note_key(source)] = {
+                'index': target_index,
+                'n': {year: target[year].n},
+                'score': score
+            }
+        
+        print(f"  Notes moved to another paragraph: {len(moves)} "
+              f"({len(orphans)} notes unaligned within their paragraph)")
+        return moves
+    
     def build_note_unified_text(self, note_1808, note_1826, note_1849):
         """Build unified text for notes with similarity scores"""
         # Calculate similarity scores between editions
         scores = {}
         
         if note_1808 and note_1826:
-            scores['1826'] = self.similarity_ratio(note_1808['plain_text'], note_1826['plain_text'])
+            scores['1826'] = self.token_similarity(note_1808.token_set, note_1826.token_set)
         
         if note_1808 and note_1849:
-            scores['1849'] = self.similarity_ratio(note_1808['plain_text'], note_1849['plain_text'])
+            scores['1849'] = self.token_similarity(note_1808.token_set, note_1849.token_set)
         elif note_1826 and note_1849:
             # If no 1808 version, compare 1826 to 1849
-            scores['1849'] = self.similarity_ratio(note_1826['plain_text'], note_1849['plain_text'])
+            scores['1849'] = self.token_similarity(note_1826.token_set, note_1849.token_set)
         
         # New in 1849
         if not note_1808 and not note_1826 and note_1849:
-            tokens = self.tokenize(note_1849['plain_text'])
+            tokens = note_1849.tokens
             return {
-                'unified_text': [{
-                    'text': token,
-                    'color': 'black',
-                    'editions': ['1849'],
-                    'type': 'new_in_1849',
-                    'category': 'addition'
-                } for token in tokens],
-                'n': note_1849['n'],
+                'unified_text': [Segment(token, BIT_1849, TYPE_CODES['new_in_1849'], 'addition') for token in tokens],
+                'n': note_1849.n,
                 'editions': ['1849'],
                 'scores': {},
                 'originals': {
                     '1808': None,
                     '1826': None,
-                    '1849': note_1849['plain_text']
+                    '1849': note_1849.plain_text
                 }
             }
         
         # New in 1826
         if not note_1808 and note_1826:
-            tokens = self.tokenize(note_1826['plain_text'])
-            unified = [{
-                'text': token,
-                'color': 'red',
-                'editions': ['1826'],
-                'type': 'new_in_1826',
-                'category': 'addition'
-            } for token in tokens]
+            tokens = note_1826.tokens
+            unified = [Segment(token, BIT_1826, TYPE_CODES['new_in_1826'], 'addition') for token in tokens]
             
             if note_1849:
-                text_1826 = note_1826['plain_text']
-                text_1849 = note_1849['plain_text']
-                tokens_1826 = self.tokenize(text_1826)
-                tokens_1849 = self.tokenize(text_1849)
-                
-                unified = self.apply_note_changes(unified, tokens_1826, tokens_1849, '1849')
+                unified = self.apply_note_changes(unified, note_1826, note_1849, '1849')
                 editions = ['1826', '1849']
             else:
                 editions = ['1826']
             
             return {
                 'unified_text': unified,
-                'n': note_1826['n'],
+                'n': note_1826.n,
                 'editions': editions,
                 'scores': scores,
                 'originals': {
                     '1808': None,
-                    '1826': note_1826['plain_text'],
-                    '1849': note_1849['plain_text'] if note_1849 else None
+                    '1826': note_1826.plain_text,
+                    '1849': note_1849.plain_text if note_1849 else None
                 }
             }
         
         # Exists in 1808
         if not note_1849:
-            tokens = self.tokenize(note_1808['plain_text']) if note_1808 else []
+            tokens = note_1808.tokens if note_1808 else []
             return {
-                'unified_text': [{
-                    'text': token,
-                    'color': 'blue',
-                    'editions': ['1808'],
-                    'type': 'original',
-                    'category': None
-                } for token in tokens],
-                'n': note_1808['n'] if note_1808 else '',
+                'unified_text': [Segment(token, BIT_1808, TYPE_CODES['original'], None) for token in tokens],
+                'n': note_1808.n if note_1808 else '',
                 'editions': ['1808'],
                 'scores': {},
                 'originals': {
-                    '1808': note_1808['plain_text'] if note_1808 else None,
+                    '1808': note_1808.plain_text if note_1808 else None,
                     '1826': None,
                     '1849': None
                 }
             }
         
         # Compare across editions
-        text_1808 = note_1808['plain_text'] if note_1808 else ''
-        text_1826 = note_1826['plain_text'] if note_1826 else ''
-        text_1849 = note_1849['plain_text'] if note_1849 else ''
+        text_1808 = note_1808.plain_text if note_1808 else ''
+        text_1826 = note_1826.plain_text if note_1826 else ''
+        text_1849 = note_1849.plain_text if note_1849 else ''
         
-        tokens_1808 = self.tokenize(text_1808) if text_1808 else []
-        tokens_1826 = self.tokenize(text_1826) if text_1826 else []
-        tokens_1849 = self.tokenize(text_1849) if text_1849 else []
+        tokens_1808 = note_1808.tokens if note_1808 else []
+        tokens_1826 = note_1826.tokens if note_1826 else []
+        tokens_1849 = note_1849.tokens if note_1849 else []
         
         segments = []
         
         if tokens_1808 and tokens_1826:
-            matcher = difflib.SequenceMatcher(None, tokens_1808, tokens_1826)
-            
-            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            for tag, i1, i2, j1, j2 in self.diff_opcodes(note_1808.token_ids, note_1826.token_ids):
                 if tag == 'equal':
                     for i in range(i1, i2):
-                        segments.append({
-                            'text': tokens_1808[i],
-                            'color': 'blue',
-                            'editions': ['1808', '1826'],
-                            'type': 'original',
-                            'category': None
-                        })
+                        segments.append(Segment(tokens_1808[i], BIT_1808 | BIT_1826, TYPE_CODES['original'], None))
                 
                 elif tag == 'replace':
                     old_text = ' '.join(tokens_1808[i1:i2])
                     new_text = ' '.join(tokens_1826[j1:j2])
                     category = self.classify_variant(old_text, new_text, 'replace')
                     
-                    segments.append({
-                        'text': old_text,
-                        'color': 'blue',
-                        'editions': ['1808'],
-                        'type': 'replaced',
-                        'replaced_by': new_text,
-                        'category': category
-                    })
+                    segments.append(Segment(old_text, BIT_1808, TYPE_CODES['replaced'], category, new_text))
                     
-                    segments.append({
-                        'text': new_text,
-                        'color': 'red',
-                        'editions': ['1826'],
-                        'type': 'replacement',
-                        'category': category
-                    })
+                    segments.append(Segment(new_text, BIT_1826, TYPE_CODES['replacement'], category))
                 
                 elif tag == 'delete':
                     for i in range(i1, i2):
-                        segments.append({
-                            'text': tokens_1808[i],
-                            'color': 'blue',
-                            'editions': ['1808'],
-                            'type': 'deleted_1826',
-                            'category': 'deletion'
-                        })
+                        segments.append(Segment(tokens_1808[i], BIT_1808, TYPE_CODES['deleted_1826'], 'deletion'))
                 
                 elif tag == 'insert':
                     for j in range(j1, j2):
-                        segments.append({
-                            'text': tokens_1826[j],
-                            'color': 'red',
-                            'editions': ['1826'],
-                            'type': 'added_1826',
-                            'category': 'addition'
-                        })
+                        segments.append(Segment(tokens_1826[j], BIT_1826, TYPE_CODES['added_1826'], 'addition'))
         elif tokens_1808:
             for token in tokens_1808:
-                segments.append({
-                    'text': token,
-                    'color': 'blue',
-                    'editions': ['1808'],
-                    'type': 'original',
-                    'category': None
-                })
+                segments.append(Segment(token, BIT_1808, TYPE_CODES['original'], None))
         
         if tokens_1849 and (tokens_1826 or tokens_1808):
-            base_tokens = tokens_1826 if tokens_1826 else tokens_1808
-            segments = self.apply_note_changes(segments, base_tokens, tokens_1849, '1849')
+            base_note = note_1826 if tokens_1826 else note_1808
+            segments = self.apply_note_changes(segments, base_note, note_1849, '1849')
         
         editions = []
         if note_1808:
@@ -437,7 +757,7 @@ class FinalAnalyzerWithAlignedNotes:
         
         return {
             'unified_text': segments,
-            'n': note_1849['n'] if note_1849 else (note_1826['n'] if note_1826 else note_1808['n']),
+            'n': note_1849.n if note_1849 else (note_1826.n if note_1826 else note_1808.n),
             'editions': editions,
             'scores': scores,
             'originals': {
@@ -447,20 +767,24 @@ class FinalAnalyzerWithAlignedNotes:
             }
         }
     
-    def apply_note_changes(self, segments, tokens_base, tokens_new, year):
+    def apply_note_changes(self, segments, base, new, year):
         """Apply changes for a new year to note segments"""
-        matcher = difflib.SequenceMatcher(None, tokens_base, tokens_new)
+        tokens_base = base.tokens
+        tokens_new = new.tokens
+        opcodes = self.diff_opcodes(base.token_ids, new.token_ids)
+        year_bit = EDITION_BITS[year]
+        added = TYPE_CODES[f'added_{year}']
+        deleted = TYPE_CODES[f'deleted_{year}']
         
         new_segments = []
         seg_idx = 0
         
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        for tag, i1, i2, j1, j2 in opcodes:
             if tag == 'equal':
                 for i in range(i1, i2):
                     if seg_idx < len(segments):
-                        seg = segments[seg_idx].copy()
-                        if year not in seg['editions']:
-                            seg['editions'].append(year)
+                        seg = segments[seg_idx]
+                        seg.editions |= year_bit
                         new_segments.append(seg)
                         seg_idx += 1
             
@@ -470,58 +794,73 @@ class FinalAnalyzerWithAlignedNotes:
                 category = self.classify_variant(old_text, new_text, 'replace')
                 
                 if seg_idx < len(segments):
-                    seg = segments[seg_idx].copy()
-                    seg['type'] = 'replaced'
-                    seg['replaced_by'] = new_text
-                    seg['category'] = category
+                    seg = segments[seg_idx]
+                    seg.kind = TYPE_CODES['replaced']
+                    seg.replaced_by = new_text
+                    seg.category = category
                     new_segments.append(seg)
                     seg_idx += (i2 - i1)
                 
-                color = 'black' if year == '1849' else 'red'
-                new_segments.append({
-                    'text': new_text,
-                    'color': color,
-                    'editions': [year],
-                    'type': f'added_{year}',
-                    'category': category
-                })
+                new_segments.append(Segment(new_text, year_bit, added, category))
             
             elif tag == 'delete':
                 for i in range(i1, i2):
                     if seg_idx < len(segments):
-                        seg = segments[seg_idx].copy()
-                        seg['type'] = f'deleted_{year}'
-                        seg['category'] = 'deletion'
+                        seg = segments[seg_idx]
+                        seg.kind = deleted
+                        seg.category = 'deletion'
                         new_segments.append(seg)
                         seg_idx += 1
             
             elif tag == 'insert':
-                color = 'black' if year == '1849' else 'red'
                 for j in range(j1, j2):
-                    new_segments.append({
-                        'text': tokens_new[j],
-                        'color': color,
-                        'editions': [year],
-                        'type': f'added_{year}',
-                        'category': 'addition'
-                    })
+                    new_segments.append(Segment(tokens_new[j], year_bit, added, 'addition'))
         
         return new_segments
     
-    def find_best_match(self, para_text, candidate_paragraphs, threshold=0.5):
-        """Find the best matching paragraph from candidates"""
-        best_match = None
-        best_score = threshold
+    def build_token_index(self, paragraphs):
+        """Build a token -> paragraph posting-list index for candidate search"""
+        token_sets = [p.token_set for p in paragraphs]
+        postings = {}
+        for idx, tokens in enumerate(token_sets):
+            for token in tokens:
+                postings.setdefault(token, []).append(idx)
+        return {'token_sets': token_sets, 'postings': postings}
+    
+    def find_best_indexed_match(self, tokens, index, used, threshold=0.5):
+        """Find the best unused paragraph in index, scoring only candidates that can pass threshold"""
         best_idx = -1
+        best_score = threshold
+        size = len(tokens)
+        if not size:
+            return best_idx, best_score
+        
+        token_sets = index['token_sets']
+        postings = index['postings']
+        
+        # Jaccard > threshold needs more than threshold * size shared tokens, so every
+        # match shares at least one of the (size - floor(threshold * size)) rarest tokens.
+        prefix_len = size - int(threshold * size)
+        prefix = sorted(tokens, key=lambda t: (len(postings.get(t, ())), t))[:prefix_len]
+        candidates = set()
+        for token in prefix:
+            candidates.update(postings.get(token, ()))
         
-        for idx, candidate in enumerate(candidate_paragraphs):
-            score = self.similarity_ratio(para_text, candidate['text'])
+        for idx in sorted(candidates):
+            if idx in used:
+                continue
+            other = token_sets[idx]
+            other_size = len(other)
+            # Jaccard is bounded by min(|A|, |B|) / max(|A|, |B|)
+            if other_size <= threshold * size or threshold * other_size >= size:
+                continue
+            intersection = len(tokens & other)
+            score = intersection / (size + other_size - intersection)
             if score > best_score:
                 best_score = score
-                best_match = candidate
                 best_idx = idx
         
-        return best_match, best_idx, best_score
+        return best_idx, best_score
     
     def align_paragraphs(self):
         """Align paragraphs across editions based on content similarity"""
@@ -535,50 +874,48 @@ class FinalAnalyzerWithAlignedNotes:
         
         print(f"\nAligning paragraphs by similarity (threshold: 50%)...")
         
+        index_1826 = self.build_token_index(paras_1826)
+        index_1849 = self.build_token_index(paras_1849)
+        
         for i, para_1808 in enumerate(paras_1808):
             if i % 10 == 0:
                 print(f"  Processing paragraph {i+1}/{len(paras_1808)}...")
             
             alignment = {
                 'index': i,
-                '1808': para_1808['text'],
-                '1808_element': para_1808.get('element'),
+                '1808': para_1808,
                 '1826': None,
-                '1826_element': None,
                 '1849': None,
-                '1849_element': None,
                 'scores': {}
             }
             
+            tokens_1808 = para_1808.token_set
+            
             if paras_1826:
-                available_1826 = [p for idx, p in enumerate(paras_1826) if idx not in used_1826]
-                match_1826, idx_1826, score_1826 = self.find_best_match(
-                    para_1808['text'], 
-                    available_1826,
+                idx_1826, score_1826 = self.find_best_indexed_match(
+                    tokens_1808,
+                    index_1826,
+                    used_1826,
                     threshold=0.5
                 )
                 
-                if match_1826:
-                    orig_idx = paras_1826.index(match_1826)
-                    alignment['1826'] = match_1826['text']
-                    alignment['1826_element'] = match_1826.get('element')
+                if idx_1826 >= 0:
+                    alignment['1826'] = paras_1826[idx_1826]
                     alignment['scores']['1826'] = score_1826
-                    used_1826.add(orig_idx)
+                    used_1826.add(idx_1826)
             
             if paras_1849:
-                available_1849 = [p for idx, p in enumerate(paras_1849) if idx not in used_1849]
-                match_1849, idx_1849, score_1849 = self.find_best_match(
-                    para_1808['text'],
-                    available_1849,
+                idx_1849, score_1849 = self.find_best_indexed_match(
+                    tokens_1808,
+                    index_1849,
+                    used_1849,
                     threshold=0.5
                 )
                 
-                if match_1849:
-                    orig_idx = paras_1849.index(match_1849)
-                    alignment['1849'] = match_1849['text']
-                    alignment['1849_element'] = match_1849.get('element')
+                if idx_1849 >= 0:
+                    alignment['1849'] = paras_1849[idx_1849]
                     alignment['scores']['1849'] = score_1849
-                    used_1849.add(orig_idx)
+                    used_1849.add(idx_1849)
             
             alignments.append(alignment)
         
@@ -588,11 +925,8 @@ class FinalAnalyzerWithAlignedNotes:
                 alignments.append({
                     'index': len(alignments),
                     '1808': None,
-                    '1808_element': None,
                     '1826': None,
-                    '1826_element': None,
-                    '1849': para_1849['text'],
-                    '1849_element': para_1849.get('element'),
+                    '1849': para_1849,
                     'scores': {},
                     'new_in_1849': True
                 })
@@ -600,119 +934,343 @@ class FinalAnalyzerWithAlignedNotes:
         print(f"  Total alignments: {len(alignments)}")
         return alignments
     
+    def find_anchor_runs(self, paras_a, paras_b, band):
+        """Diagonal runs of anchor pairs (i, j), ordered by i.
+        
+        Anchors are paragraph pairs sharing at least two tokens that occur in no other
+        paragraph of either edition. Consecutive anchors continue a run while j moves
+        forward by at most band more than i, so a block moved elsewhere in paras_b
+        starts a run of its own. Anchors that fit neither neighbour are dropped.
+        """
+        owner_a = {}
+        for i, para in enumerate(paras_a):
+            for token in para.token_set:
+                owner_a[token] = -1 if token in owner_a else i
+        owner_b = {}
+        for j, para in enumerate(paras_b):
+            for token in para.token_set:
+                owner_b[token] = -1 if token in owner_b else j
+        
+        votes = {}
+        for token, i in owner_a.items():
+            j = owner_b.get(token, -1)
+            if i >= 0 and j >= 0:
+                votes[(i, j)] = votes.get((i, j), 0) + 1
+        best = {}
+        for (i, j), count in votes.items():
+            if count >= 2 and count > best.get(i, (0, 0))[0]:
+                best[i] = (count, j)
+        anchors = [(i, best[i][1]) for i in sorted(best)]
+        
+        def fits(first, second):
+            di = second[0] - first[0]
+            dj = second[1] - first[1]
+            return 0 < dj <= di + band and di <= band
+        
+        anchors = [
+            anchor for k, anchor in enumerate(anchors)
+            if (k > 0 and fits(anchors[k - 1], anchor)) or (k + 1 < len(anchors) and fits(anchor, anchors[k + 1]))
+        ]
+        runs = []
+        for anchor in anchors:
+            if runs and fits(runs[-1][-1], anchor):
+                runs[-1].append(anchor)
+            else:
+                runs.append([anchor])
+        return runs
+    
+    def align_sequence_banded(self, paras_a, paras_b, band=10, threshold=0.5):
+        """Order-preserving alignment of paras_b to paras_a as (a_indices, b_indices, score) groups.
+        
+        paras_a is cut into blocks at the anchor runs; each block is aligned against the
+        part of paras_b its run points to, so blocks moved between editions are still
+        found. Longer blocks claim their paragraphs of paras_b first.
+        """
+        n = len(paras_a)
+        m = len(paras_b)
+        if not n or not m:
+            return []
+        
+        runs = self.find_anchor_runs(paras_a, paras_b, band)
+        if not runs:
+            ratio = m / n
+            runs = [[(0, 0), (n - 1, int((n - 1) * ratio))]]
+        
+        blocks = []
+        for k, run in enumerate(runs):
+            start = 0 if k == 0 else run[0][0]
+            end = runs[k + 1][0][0] if k + 1 < len(runs) else n
+            centers = []
+            a = 0
+            for i in range(start, end):
+                while a < len(run) and run[a][0] < i:
+                    a += 1
+                if a == 0:
+                    centers.append(run[0][1] - (run[0][0] - i))
+                elif a == len(run):
+                    centers.append(run[-1][1] + (i - run[-1][0]))
+                else:
+                    (i0, j0), (i1, j1) = run[a - 1], run[a]
+                    centers.append(j0 + (j1 - j0) * (i - i0) / (i1 - i0))
+            blocks.append((len(run), start, end, centers))
+        
+        groups = []
+        used_b = set()
+        for _, start, end, centers in sorted(blocks, key=lambda block: -block[0]):
+            first = max(0, int(min(centers)) - band)
+            last = min(m, int(max(centers)) + band + 1)
+            if first >= last:
+                continue
+            block_groups = self.banded_dp(
+                [para.token_set for para in paras_a[start:end]],
+                [paras_b[j].token_set if j not in used_b else frozenset() for j in range(first, last)],
+                [center - first for center in centers],
+                band,
+                threshold
+            )
+            for a_indices, b_indices, score in block_groups:
+                b_indices = tuple(first + j for j in b_indices)
+                used_b.update(b_indices)
+                groups.append((tuple(start + i for i in a_indices), b_indices, score))
+        groups.sort()
+        return groups
+    
+    def banded_dp(self, sets_a, sets_b, centers, band, threshold):
+        """Best order-preserving 1:1, 1:2 and 2:1 matching of two token set sequences.
+        
+        Row i (i sets of sets_a consumed) only covers columns within band of the centers
+        of its own and neighbouring rows, so the cost is O(len(sets_a) * band). The
+        summed Jaccard scores of the matches are maximized; every part of a split or
+        merge must share at least threshold of its tokens with the other side.
+        """
+        n = len(sets_a)
+        m = len(sets_b)
+        lo = [0] * (n + 1)
+        hi = [m] * (n + 1)
+        for i in range(1, n + 1):
+            # Neighbouring centers make consecutive rows overlap even across jumps
+            nearby = centers[max(0, i - 2):min(n, i + 1)]
+            lo[i] = min(m, max(0, int(min(nearby)) - band))
+            hi[i] = max(lo[i], min(m, int(max(nearby)) + band + 1))
+        
+        def jaccard(tokens_a, tokens_b):
+            size_a = len(tokens_a)
+            size_b = len(tokens_b)
+            # Jaccard is bounded by min / max of the sizes
+            if not size_a or not size_b or min(size_a, size_b) <= threshold * max(size_a, size_b):
+                return 0.0
+            shared = len(tokens_a & tokens_b)
+            return shared / (size_a + size_b - shared)
+        
+        def covered(part, other):
+            return part and len(part & other) >= threshold * len(part)
+        
+        pairs_b = {}
+        minus_inf = float('-inf')
+        rows = [[0.0] * (m + 1)]
+        moves = [None]
+        
+        def value(i, j):
+            if j < lo[i] or j > hi[i]:
+                return minus_inf
+            return rows[i][j - lo[i]]
+        
+        for i in range(1, n + 1):
+            tokens_a = sets_a[i - 1]
+            merged_a = sets_a[i - 2] | tokens_a if i >= 2 else None
+            row = []
+            row_moves = []
+            for j in range(lo[i], hi[i] + 1):
+                best = minus_inf
+                move = None
+                if j >= 1:
+                    previous = value(i - 1, j - 1)
+                    if previous > minus_inf:
+                        score = jaccard(tokens_a, sets_b[j - 1])
+                        if score > threshold:
+                            best, move = previous + score, (1, 1, score)
+                if j >= 2:
+                    previous = value(i - 1, j - 2)
+                    if previous > minus_inf:
+                        merged_b = pairs_b.get(j)
+                        if merged_b is None:
+                            merged_b = pairs_b[j] = sets_b[j - 2] | sets_b[j - 1]
+                        score = jaccard(tokens_a, merged_b)
+                        if (score > threshold and previous + score > best
+                                and covered(sets_b[j - 2], tokens_a) and covered(sets_b[j - 1], tokens_a)):
+                            best, move = previous + score, (1, 2, score)
+                if merged_a is not None and j >= 1:
+                    previous = value(i - 2, j - 1)
+                    if previous > minus_inf:
+                        tokens_b = sets_b[j - 1]
+                        score = jaccard(merged_a, tokens_b)
+                        if (score > threshold and previous + score > best
+                                and covered(sets_a[i - 2], tokens_b) and covered(tokens_a, tokens_b)):
+                            best, move = previous + score, (2, 1, score)
+                previous = value(i - 1, j)
+                if previous > best:
+                    best, move = previous, (1, 0, 0.0)
+                if row and row[-1] > best:
+                    best, move = row[-1], (0, 1, 0.0)
+                row.append(best)
+                row_moves.append(move)
+            rows.append(row)
+            moves.append(row_moves)
+        
+        # Trailing sets of sets_b may stay unmatched
+        i = n
+        j = max(range(lo[n], hi[n] + 1), key=lambda col: (rows[n][col - lo[n]], -col))
+        groups = []
+        while i > 0:
+            da, db, score = moves[i][j - lo[i]]
+            if da and db:
+                groups.append((tuple(range(i - da, i)), tuple(range(j - db, j)), score))
+            i -= da
+            j -= db
+        groups.reverse()
+        return groups
+    
+    def align_paragraphs_banded(self, band=10):
+        """Align paragraphs in document order with banded dynamic programming"""
+        paras_1808 = self.editions.get('1808', [])
+        paras_1826 = self.editions.get('1826', [])
+        paras_1849 = self.editions.get('1849', [])
+        
+        print(f"\nAligning paragraphs in order (banded DP, band: {band}, threshold: 50%)...")
+        
+        matched = {}
+        joined_with_next = [False] * len(paras_1808)
+        for year, paras in (('1826', paras_1826), ('1849', paras_1849)):
+            matched[year] = [[] for _ in paras_1808]
+            for a_indices, b_indices, _ in self.align_sequence_banded(paras_1808, paras, band):
+                for i in a_indices:
+                    matched[year][i].extend(b_indices)
+                if len(a_indices) == 2:
+                    joined_with_next[a_indices[0]] = True
+        
+        # Consecutive 1808 paragraphs merged in either edition form one alignment
+        rows = []
+        start = 0
+        for i in range(len(paras_1808)):
+            if not joined_with_next[i]:
+                rows.append(list(range(start, i + 1)))
+                start = i + 1
+        
+        alignments = []
+        used_1849 = {j for indices in matched['1849'] for j in indices}
+        next_new_1849 = 0
+        
+        def add_new_1849(before):
+            nonlocal next_new_1849
+            while next_new_1849 < before:
+                if next_new_1849 not in used_1849:
+                    alignments.append({
+                        'index': len(alignments),
+                        '1808': None,
+                        '1826': None,
+                        '1849': paras_1849[next_new_1849],
+                        'scores': {},
+                        'new_in_1849': True
+                    })
+                next_new_1849 += 1
+        
+        for row in rows:
+            para_1808 = Paragraph.joined([paras_1808[i] for i in row], self.vocabulary)
+            alignment = {
+                'index': None,
+                '1808': para_1808,
+                '1826': None,
+                '1849': None,
+                'scores': {}
+            }
+            merged = {}
+            if len(row) > 1:
+                merged['1808'] = row
+            for year, paras in (('1826', paras_1826), ('1849', paras_1849)):
+                b_indices = sorted({j for i in row for j in matched[year][i]})
+                if not b_indices:
+                    continue
+                if year == '1849':
+                    # Unmatched 1849 paragraphs keep their place in document order
+                    add_new_1849(b_indices[0])
+                para = Paragraph.joined([paras[j] for j in b_indices], self.vocabulary)
+                alignment[year] = para
+                alignment['scores'][year] = self.token_similarity(para_1808.token_set, para.token_set)
+                if len(b_indices) > 1:
+                    merged[year] = b_indices
+            if merged:
+                alignment['merged'] = merged
+            alignment['index'] = len(alignments)
+            alignments.append(alignment)
+        add_new_1849(len(paras_1849))
+        
+        splits = sum(1 for alignment in alignments if 'merged' in alignment)
+        print(f"  Total alignments: {len(alignments)} ({splits} with split or merged paragraphs)")
+        return alignments
+    
     def build_unified_text(self, para_1808, para_1826, para_1849):
         """Build unified text with provenance tracking AND classification"""
         if not para_1808 and not para_1826 and para_1849:
-            tokens = self.tokenize(para_1849)
-            return [{
-                'text': token,
-                'color': 'black',
-                'editions': ['1849'],
-                'type': 'new_in_1849',
-                'category': 'addition'
-            } for token in tokens]
+            tokens = para_1849.tokens
+            return [Segment(token, BIT_1849, TYPE_CODES['new_in_1849'], 'addition') for token in tokens]
         
         if not para_1849:
-            tokens = self.tokenize(para_1808) if para_1808 else []
-            return [{
-                'text': token,
-                'color': 'blue',
-                'editions': ['1808'],
-                'type': 'original',
-                'category': None
-            } for token in tokens]
+            tokens = para_1808.tokens if para_1808 else []
+            return [Segment(token, BIT_1808, TYPE_CODES['original'], None) for token in tokens]
         
-        tokens_1808 = self.tokenize(para_1808) if para_1808 else []
-        tokens_1826 = self.tokenize(para_1826) if para_1826 else []
-        tokens_1849 = self.tokenize(para_1849) if para_1849 else []
+        tokens_1808 = para_1808.tokens if para_1808 else []
+        tokens_1826 = para_1826.tokens if para_1826 else []
+        tokens_1849 = para_1849.tokens if para_1849 else []
         
         segments = []
         
         if tokens_1808 and tokens_1826:
-            matcher = difflib.SequenceMatcher(None, tokens_1808, tokens_1826)
-            
-            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            for tag, i1, i2, j1, j2 in self.diff_opcodes(para_1808.token_ids, para_1826.token_ids):
                 if tag == 'equal':
                     for i in range(i1, i2):
-                        segments.append({
-                            'text': tokens_1808[i],
-                            'color': 'blue',
-                            'editions': ['1808', '1826'],
-                            'type': 'original',
-                            'category': None
-                        })
+                        segments.append(Segment(tokens_1808[i], BIT_1808 | BIT_1826, TYPE_CODES['original'], None))
                 
                 elif tag == 'replace':
                     old_text = ' '.join(tokens_1808[i1:i2])
                     new_text = ' '.join(tokens_1826[j1:j2])
                     category = self.classify_variant(old_text, new_text, 'replace')
                     
-                    segments.append({
-                        'text': old_text,
-                        'color': 'blue',
-                        'editions': ['1808'],
-                        'type': 'replaced',
-                        'replaced_by': new_text,
-                        'category': category
-                    })
+                    segments.append(Segment(old_text, BIT_1808, TYPE_CODES['replaced'], category, new_text))
                     
-                    segments.append({
-                        'text': new_text,
-                        'color': 'red',
-                        'editions': ['1826'],
-                        'type': 'replacement',
-                        'category': category
-                    })
+                    segments.append(Segment(new_text, BIT_1826, TYPE_CODES['replacement'], category))
                 
                 elif tag == 'delete':
                     for i in range(i1, i2):
-                        segments.append({
-                            'text': tokens_1808[i],
-                            'color': 'blue',
-                            'editions': ['1808'],
-                            'type': 'deleted_1826',
-                            'category': 'deletion'
-                        })
+                        segments.append(Segment(tokens_1808[i], BIT_1808, TYPE_CODES['deleted_1826'], 'deletion'))
                 
                 elif tag == 'insert':
                     for j in range(j1, j2):
-                        segments.append({
-                            'text': tokens_1826[j],
-                            'color': 'red',
-                            'editions': ['1826'],
-                            'type': 'added_1826',
-                            'category': 'addition'
-                        })
+                        segments.append(Segment(tokens_1826[j], BIT_1826, TYPE_CODES['added_1826'], 'addition'))
         elif tokens_1808:
             for token in tokens_1808:
-                segments.append({
-                    'text': token,
-                    'color': 'blue',
-                    'editions': ['1808'],
-                    'type': 'original',
-                    'category': None
-                })
+                segments.append(Segment(token, BIT_1808, TYPE_CODES['original'], None))
         
         if tokens_1849 and (tokens_1826 or tokens_1808):
-            base_tokens = tokens_1826 if tokens_1826 else tokens_1808
-            segments = self.apply_1849_changes(segments, base_tokens, tokens_1849)
+            base_para = para_1826 if tokens_1826 else para_1808
+            segments = self.apply_1849_changes(segments, base_para, para_1849)
         
         return segments
     
-    def apply_1849_changes(self, segments, tokens_base, tokens_1849):
+    def apply_1849_changes(self, segments, base, para_1849):
         """Apply 1849 changes with classification"""
-        matcher = difflib.SequenceMatcher(None, tokens_base, tokens_1849)
+        tokens_base = base.tokens
+        tokens_1849 = para_1849.tokens
+        opcodes = self.diff_opcodes(base.token_ids, para_1849.token_ids)
         
         new_segments = []
         seg_idx = 0
         
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        for tag, i1, i2, j1, j2 in opcodes:
             if tag == 'equal':
                 for i in range(i1, i2):
                     if seg_idx < len(segments):
-                        seg = segments[seg_idx].copy()
-                        if '1849' not in seg['editions']:
-                            seg['editions'].append('1849')
+                        seg = segments[seg_idx]
+                        seg.editions |= BIT_1849
                         new_segments.append(seg)
                         seg_idx += 1
             
@@ -722,71 +1280,228 @@ class FinalAnalyzerWithAlignedNotes:
                 category = self.classify_variant(old_text, new_text, 'replace')
                 
                 if seg_idx < len(segments):
-                    seg = segments[seg_idx].copy()
-                    seg['type'] = 'replaced'
-                    seg['replaced_by'] = new_text
-                    seg['category'] = category
+                    seg = segments[seg_idx]
+                    seg.kind = TYPE_CODES['replaced']
+                    seg.replaced_by = new_text
+                    seg.category = category
                     new_segments.append(seg)
                     seg_idx += (i2 - i1)
                 
-                new_segments.append({
-                    'text': new_text,
-                    'color': 'black',
-                    'editions': ['1849'],
-                    'type': 'added_1849',
-                    'category': category
-                })
+                new_segments.append(Segment(new_text, BIT_1849, TYPE_CODES['added_1849'], category))
             
             elif tag == 'delete':
                 for i in range(i1, i2):
                     if seg_idx < len(segments):
-                        seg = segments[seg_idx].copy()
-                        seg['type'] = 'deleted_1849'
-                        seg['category'] = 'deletion'
+                        seg = segments[seg_idx]
+                        seg.kind = TYPE_CODES['deleted_1849']
+                        seg.category = 'deletion'
                         new_segments.append(seg)
                         seg_idx += 1
             
             elif tag == 'insert':
                 for j in range(j1, j2):
-                    new_segments.append({
-                        'text': tokens_1849[j],
-                        'color': 'black',
-                        'editions': ['1849'],
-                        'type': 'added_1849',
-                        'category': 'addition'
-                    })
+                    new_segments.append(Segment(tokens_1849[j], BIT_1849, TYPE_CODES['added_1849'], 'addition'))
         
         return new_segments
     
-    def map_note_positions_to_tokens(self, text, note_positions):
-        """Map character positions to token positions"""
-        tokens = self.tokenize(text)
-        token_positions = []
-        
-        current_pos = 0
-        for token in tokens:
-            token_start = text.find(token, current_pos)
-            if token_start == -1:
-                token_start = current_pos
-            token_end = token_start + len(token)
-            token_positions.append((token_start, token_end, token))
-            current_pos = token_end
-        
-        note_to_token_map = {}
-        for note in note_positions:
-            note_pos = note['position']
-            best_token_idx = 0
-            for idx, (start, end, token) in enumerate(token_positions):
-                if note_pos >= start:
-                    best_token_idx = idx
-                else:
-                    break
-            note_to_token_map[note['n']] = best_token_idx
+    def map_note_positions_to_tokens(self, paragraph, note_positions):
+        """Map character positions to the index of the last token starting at or before them"""
+        token_starts = paragraph.token_starts
+        return {
+            note.n: max(bisect_right(token_starts, note.position) - 1, 0)
+            for note in note_positions
+        }
+    
+    def prepare_work_unit(self, alignment):
+        """Bundle an alignment with its notes and their alignment within the paragraph, free of lxml elements"""
+        notes = {}
+        with self.stage('note lookup'):
+            for year in ('1808', '1826', '1849'):
+                para = alignment.get(year)
+                note_data = self.lookup_note_markers(para.note_markers, year) if para is not None else []
+                notes[year] = [Note(*note, year, self.vocabulary) for note in note_data]
+        with self.stage('note align'):
+            aligned_notes = self.align_notes(notes['1808'], notes['1826'], notes['1849'])
+        return alignment, notes, aligned_notes
+    
+    def process_alignment(self, alignment, notes, aligned_notes):
+        """Build the result entry and variant counts for one paragraph alignment"""
+        if self.profiler is not None:
+            return self.profile_alignment(alignment, notes, aligned_notes)
+        unified = self.build_unified_text(
+            alignment.get('1808'),
+            alignment.get('1826'),
+            alignment.get('1849')
+        )
+        variant_stats = self.count_variants(unified)
+        note_positions, unified_notes = self.build_notes(alignment, notes, aligned_notes)
+        return self.make_result(alignment, unified, note_positions, unified_notes), variant_stats
+    
+    def profile_alignment(self, alignment, notes, aligned_notes):
+        """process_alignment split into profiler stages, timing the paragraph as one item"""
+        profiler = self.profiler
+        with profiler.item(f"paragraph {alignment['index']}", {'index': alignment['index']}) as info:
+            with profiler.stage('unify'):
+                unified = self.build_unified_text(
+                    alignment.get('1808'),
+                    alignment.get('1826'),
+                    alignment.get('1849')
+                )
+                variant_stats = self.count_variants(unified)
+            with profiler.stage('notes'):
+                note_positions, unified_notes = self.build_notes(alignment, notes, aligned_notes)
+            with profiler.stage('result'):
+                result = self.make_result(alignment, unified, note_positions, unified_notes)
+        info['tokens'] = {
+            year: len(alignment[year].token_ids) if alignment.get(year) else 0
+            for year in ('1808', '1826', '1849')
+        }
+        info['notes'] = {year: len(year_notes) for year, year_notes in notes.items()}
+        info['segments'] = len(unified)
+        return result, variant_stats
+    
+    def count_variants(self, unified):
+        """Count the segments of a unified text per variant category"""
+        variant_stats = {
+            'orthographic': 0,
+            'lexical': 0,
+            'substitution': 0,
+            'addition': 0,
+            'deletion': 0
+        }
+        for seg in unified:
+            if seg.category in variant_stats:
+                variant_stats[seg.category] += 1
+        return variant_stats
+    
+    def make_result(self, alignment, unified, note_positions, unified_notes):
+        """Build the output entry for one paragraph alignment"""
+        para_1808 = alignment.get('1808')
+        para_1826 = alignment.get('1826')
+        para_1849 = alignment.get('1849')
+        
+        result = {
+            'index': alignment['index'],
+            'data': {
+                'unified_text': segments_to_json(unified),
+                'originals': {
+                    '1808': para_1808.text if para_1808 else None,
+                    '1826': para_1826.text if para_1826 else None,
+                    '1849': para_1849.text if para_1849 else None
+                },
+                'notes': unified_notes,
+                'note_positions': note_positions,
+                'scores': alignment.get('scores', {}),
+                'new_in_1849': alignment.get('new_in_1849', False)
+            }
+        }
+        if 'merged' in alignment:
+            result['data']['merged'] = alignment['merged']
+        return result
+    
+    def build_notes(self, alignment, notes, aligned_notes):
+        """Map note positions to tokens and build the unified texts of the aligned notes"""
+        note_positions = {}
+        for year in ('1808', '1826', '1849'):
+            para = alignment.get(year)
+            if para and notes[year]:
+                note_positions[year] = self.map_note_positions_to_tokens(para, notes[year])
+        
+        note_moves = alignment.get('note_moves')
+        
+        unified_notes = []
+        for note_alignment in aligned_notes:
+            moved_from = moved_to = None
+            if note_moves:
+                key = self.note_key(note_alignment)
+                moved_from = note_moves['from'].get(key)
+                moved_to = note_moves['to'].get(key)
+                if moved_from:
+                    # Compared with its earlier text from the paragraph it moved out of;
+                    # a copy, as the work unit may be built again (--serve)
+                    note_alignment = {**note_alignment, **moved_from['notes']}
+            unified_note = self.build_note_unified_text(
+                note_alignment.get('1808'),
+                note_alignment.get('1826'),
+                note_alignment.get('1849')
+            )
+            unified_note['unified_text'] = segments_to_json(unified_note['unified_text'])
+            if moved_from:
+                unified_note['moved_from'] = {
+                    'index': moved_from['index'],
+                    'n': {year: note.n for year, note in moved_from['notes'].items()},
+                    'score': moved_from['score']
+                }
+            if moved_to:
+                unified_note['moved_to'] = moved_to
+            unified_notes.append(unified_note)
         
-        return note_to_token_map
+        return note_positions, unified_notes
     
-    def analyze(self):
-        alignments = self.align_paragraphs()
+    def write_sharded_output(self, output, shard_dir, shard_size=50):
+        """Write output as shard_dir/manifest.json plus fixed-size paragraph shards"""
+        os.makedirs(shard_dir, exist_ok=True)
+        content = output['content']
+        shards = []
+        for shard_no, start in enumerate(range(0, len(content), shard_size)):
+            end = min(start + shard_size, len(content))
+            name = f'shard-{shard_no:05d}.json'
+            with open(os.path.join(shard_dir, name), 'w', encoding='utf-8') as f:
+                json.dump({'start': start, 'content': content[start:end]}, f, ensure_ascii=False, indent=2)
+            shards.append({'file': name, 'start': start, 'end': end})
+        
+        manifest = {
+            'metadata': output['metadata'],
+            'total': len(content),
+            'shard_size': shard_size,
+            'toc': [
+                {'index': item['index'], 'new_in_1849': item['data']['new_in_1849']}
+                for item in content
+            ],
+            'shards': shards
+        }
+        with open(os.path.join(shard_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        return manifest
+    
+    def make_output(self, results, variant_stats, note_moves=True):
+        """Wrap result entries in the output document with witness metadata"""
+        metadata = {
+            'witnesses': [
+                {'year': '1808', 'color': '#3498db', 'label': '1. Ausgabe (Tübingen 1808)'},
+                {'year': '1826', 'color': '#e74c3c', 'label': '2. Ausgabe (1826)'},
+                {'year': '1849', 'color': '#2c3e50', 'label': '3. Ausgabe (1849)'}
+            ],
+            'total_paragraphs': len(results)
+        }
+        if note_moves:
+            # Left out when the search did not run, so "not searched" differs from "none found"
+            metadata['moved_notes'] = sum(
+                1 for result in results for note in result['data']['notes'] if 'moved_from' in note
+            )
+        metadata['variant_statistics'] = variant_stats
+        return {
+            'metadata': metadata,
+            'content': results
+        }
+    
+    def align(self, align='greedy', band=10, note_moves=True):
+        """Work units of the loaded editions' paragraph alignments, with notes moved between paragraphs marked"""
+        with self.stage('align'):
+            if align == 'banded':
+                alignments = self.align_paragraphs_banded(band)
+            else:
+                alignments = self.align_paragraphs()
+        work_units = [self.prepare_work_unit(alignment) for alignment in alignments]
+        if note_moves:
+            print(f"\nAligning notes across paragraphs (MinHash/LSH)...")
+            with self.stage('note moves'):
+                self.find_moved_notes(work_units)
+        return work_units
+    
+    def analyze(self, jobs=1, shard_dir=None, shard_size=50, align='greedy', band=10, note_moves=True,
+                output_path='comparison_provenance.json'):
+        work_units = self.align(align, band, note_moves)
         results = []
         
         print(f"\nBuilding unified texts with aligned notes...")
@@ -799,115 +1514,362 @@ class FinalAnalyzerWithAlignedNotes:
             'deletion': 0
         }
         
-        for i, alignment in enumerate(alignments):
-            if i % 50 == 0:
-                print(f"  Processing {i+1}/{len(alignments)}...")
-            
-            unified = self.build_unified_text(
-                alignment.get('1808'),
-                alignment.get('1826'),
-                alignment.get('1849')
-            )
-            
-            for seg in unified:
-                if seg.get('category') and seg['category'] in variant_stats:
-                    variant_stats[seg['category']] += 1
-            
-            notes_with_pos_1808 = []
-            notes_with_pos_1826 = []
-            notes_with_pos_1849 = []
-            
-            elem_1808 = alignment.get('1808_element')
-            elem_1826 = alignment.get('1826_element')
-            elem_1849 = alignment.get('1849_element')
-            
-            if elem_1808 is not None:
-                notes_with_pos_1808 = self.extract_note_positions_from_paragraph(elem_1808, '1808')
-            if elem_1826 is not None:
-                notes_with_pos_1826 = self.extract_note_positions_from_paragraph(elem_1826, '1826')
-            if elem_1849 is not None:
-                notes_with_pos_1849 = self.extract_note_positions_from_paragraph(elem_1849, '1849')
-            
-            note_positions = {}
-            if alignment.get('1808') and notes_with_pos_1808:
-                note_positions['1808'] = self.map_note_positions_to_tokens(alignment['1808'], notes_with_pos_1808)
-            if alignment.get('1826') and notes_with_pos_1826:
-                note_positions['1826'] = self.map_note_positions_to_tokens(alignment['1826'], notes_with_pos_1826)
-            if alignment.get('1849') and notes_with_pos_1849:
-                note_positions['1849'] = self.map_note_positions_to_tokens(alignment['1849'], notes_with_pos_1849)
-            
-            aligned_notes = self.align_notes(notes_with_pos_1808, notes_with_pos_1826, notes_with_pos_1849)
-            
-            unified_notes = []
-            for note_alignment in aligned_notes:
-                unified_note = self.build_note_unified_text(
-                    note_alignment.get('1808'),
-                    note_alignment.get('1826'),
-                    note_alignment.get('1849')
-                )
-                unified_notes.append(unified_note)
-            
-            results.append({
-                'index': alignment['index'],
-                'data': {
-                    'unified_text': unified,
-                    'originals': {
-                        '1808': alignment.get('1808', ''),
-                        '1826': alignment.get('1826', ''),
-                        '1849': alignment.get('1849', '')
-                    },
-                    'notes': unified_notes,
-                    'note_positions': note_positions,
-                    'scores': alignment.get('scores', {}),
-                    'new_in_1849': alignment.get('new_in_1849', False)
-                }
-            })
-        
-        output = {
-            'metadata': {
-                'witnesses': [
-                    {'year': '1808', 'color': '#3498db', 'label': '1. Ausgabe (Tübingen 1808)'},
-                    {'year': '1826', 'color': '#e74c3c', 'label': '2. Ausgabe (1826)'},
-                    {'year': '1849', 'color': '#2c3e50', 'label': '3. Ausgabe (1849)'}
-                ],
-                'total_paragraphs': len(results),
-                'variant_statistics': variant_stats
-            },
-            'content': results
-        }
+        if jobs > 1:
+            print(f"  Using {jobs} worker processes")
+            executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                           initargs=(self.diff_engine,))
+            chunksize = max(1, len(work_units) // (jobs * 8))
+            processed = executor.map(process_work_unit, work_units, chunksize=chunksize)
+        else:
+            executor = None
+            processed = (self.process_alignment(*unit) for unit in work_units)
         
-        with open('comparison_provenance.json', 'w', encoding='utf-8') as f:
-            json.dump(output, f, ensure_ascii=False, indent=2)
+        try:
+            for i, (result, counts) in enumerate(processed):
+                if i % 50 == 0:
+                    print(f"  Processing {i+1}/{len(work_units)}...")
+                
+                for category, count in counts.items():
+                    variant_stats[category] += count
+                results.append(result)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        
+        output = self.make_output(results, variant_stats, note_moves)
+        
+        with self.stage('serialize'):
+            if shard_dir:
+                manifest = self.write_sharded_output(output, shard_dir, shard_size)
+                generated = f"{os.path.join(shard_dir, 'manifest.json')} ({len(manifest['shards'])} shards)"
+            else:
+                with open(output_path, 'w', encoding='utf-8') as f:
+                    json.dump(output, f, ensure_ascii=False, indent=2)
+                generated = output_path
         
         print(f"\n{'='*60}")
-        print(f"✓ Generated comparison_provenance.json")
+        print(f"✓ Generated {generated}")
         print(f"  {len(results)} paragraph alignments")
         print(f"\nVariant statistics:")
         for vtype, count in variant_stats.items():
             print(f"  {vtype:15s}: {count:5d}")
         print('='*60)
+        if self.diff_report is not None:
+            self.diff_report(sys.stdout)
+        return output['metadata']
+
+_worker_analyzer = None
+
+def init_worker(diff_engine):
+    """Create the worker process's analyzer with the parent's diff engine"""
+    global _worker_analyzer
+    _worker_analyzer = FinalAnalyzerWithAlignedNotes(diff_engine)
+
+def process_work_unit(unit):
+    """Process one work unit from prepare_work_unit in a worker process"""
+    return _worker_analyzer.process_alignment(*unit)
+
+def edition_year(filename):
+    """Edition year named in a TEI filename, or None"""
+    name = os.path.basename(filename).lower()
+    return next((year for year in EDITIONS if year in name), None)
+
+def find_edition_files(directory='.'):
+    """Find the TEI file of each edition by the year in its filename"""
+    files = {}
+    for path in Path(directory).glob('*.xml'):
+        year = edition_year(path.name)
+        if year:
+            files[year] = str(path)
+    return files
+
+def load_editions(analyzer, files, stream=False):
+    """Load files ({year: path, or a list of volume paths}) into analyzer"""
+    for year, filepath in files.items():
+        if filepath:
+            with analyzer.stage('load'):
+                if isinstance(filepath, list):
+                    analyzer.load_volumes(filepath, year, stream)
+                elif stream:
+                    analyzer.load_tei_streaming(filepath, year)
+                else:
+                    analyzer.load_tei(filepath, year)
+
+def edition_volumes(paths):
+    """Group paths by edition year, each year's volumes in filename order; also the paths without a year"""
+    volumes = {}
+    skipped = []
+    for path in paths:
+        year = edition_year(path)
+        if year:
+            volumes.setdefault(year, []).append(path)
+        else:
+            skipped.append(path)
+    return {year: sorted(volumes[year], key=os.path.basename) for year in EDITIONS if year in volumes}, skipped
+
+def catalog_files(catalog_path):
+    """Edition volumes of a collection catalog (<collection><doc href="..."/>), and the docs without a year"""
+    base = os.path.dirname(os.path.abspath(catalog_path))
+    hrefs = [doc.get('href') for doc in etree.parse(catalog_path).getroot().iter('doc') if doc.get('href')]
+    return edition_volumes([os.path.join(base, href) for href in hrefs])
+
+def read_batch_manifest(manifest_path):
+    """Document sets of a batch manifest
+    
+    The manifest is a collection catalog (one set) or a JSON list of sets, each with an
+    optional "name" and one of "files" ({year: path or list of volume paths}), "dir" or
+    "catalog". Relative paths are resolved against the manifest's directory. Every set's
+    files are {year: [volume paths]}; a year's volumes are loaded as one witness.
+    """
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    if manifest_path.endswith('.xml'):
+        entries = [{'catalog': os.path.basename(manifest_path)}]
+    else:
+        with open(manifest_path, encoding='utf-8') as f:
+            entries = json.load(f)
+    sets = []
+    names = set()
+    for i, entry in enumerate(entries):
+        skipped = []
+        if 'files' in entry:
+            files = {}
+            for year in EDITIONS:
+                paths = entry['files'].get(year)
+                if paths:
+                    paths = [paths] if isinstance(paths, str) else paths
+                    files[year] = [os.path.join(base, path) for path in paths]
+            source = None
+        elif 'dir' in entry:
+            source = entry['dir']
+            files, _ = edition_volumes(sorted(str(path) for path in Path(base, source).glob('*.xml')))
+        elif 'catalog' in entry:
+            source = entry['catalog']
+            files, skipped = catalog_files(os.path.join(base, source))
+        else:
+            raise ValueError(f"{manifest_path}: set {i} has no 'files', 'dir' or 'catalog'")
+        name = entry.get('name') or (Path(source).stem if source else f'set-{i + 1}')
+        if name in names:
+            name = f'{name}-{i + 1}'
+        names.add(name)
+        sets.append({'name': name, 'files': files, 'skipped': skipped})
+    return sets
+
+def run_document_set(doc_set, out_dir, options):
+    """Analyze one document set into out_dir/<name>, logging to log.txt there"""
+    set_dir = os.path.join(out_dir, doc_set['name'])
+    os.makedirs(set_dir, exist_ok=True)
+    output_path = os.path.join(set_dir, 'comparison_provenance.json')
+    entry = {
+        'name': doc_set['name'],
+        'files': doc_set['files'],
+        'skipped': doc_set['skipped'],
+        'output': os.path.relpath(output_path, out_dir),
+        'log': os.path.relpath(os.path.join(set_dir, 'log.txt'), out_dir)
+    }
+    start = time.perf_counter()
+    with open(os.path.join(set_dir, 'log.txt'), 'w', encoding='utf-8') as log, redirect_stdout(log):
+        try:
+            if not doc_set['files']:
+                raise ValueError('no edition files')
+            for paths in doc_set['files'].values():
+                for path in paths:
+                    if not os.path.exists(path):
+                        raise FileNotFoundError(path)
+            for path in doc_set['skipped']:
+                print(f"Skipping {path}: no edition year in its name")
+            analyzer = FinalAnalyzerWithAlignedNotes(options['diff_engine'], options['check_diff'])
+            load_editions(analyzer, doc_set['files'], options['stream'])
+            metadata = analyzer.analyze(align=options['align'], band=options['band'],
+                                        note_moves=options['note_moves'], output_path=output_path)
+            entry['status'] = 'ok'
+            entry['total_paragraphs'] = metadata['total_paragraphs']
+            if 'moved_notes' in metadata:
+                entry['moved_notes'] = metadata['moved_notes']
+            entry['variant_statistics'] = metadata['variant_statistics']
+        except Exception as e:
+            print(f"Error: {e!r}")
+            entry['status'] = 'error'
+            entry['error'] = repr(e)
+    entry['seconds'] = round(time.perf_counter() - start, 2)
+    return entry
+
+def run_batch(manifest_path, out_dir, jobs=1, **options):
+    """Analyze every document set of the manifest, jobs sets at a time, and write out_dir/index.json"""
+    sets = read_batch_manifest(manifest_path)
+    os.makedirs(out_dir, exist_ok=True)
+    print(f"Batch: {len(sets)} document sets from {manifest_path}, {jobs} at a time")
+    for doc_set in sets:
+        for path in doc_set['skipped']:
+            print(f"Warning: {doc_set['name']}: skipping {path}: no edition year in its name", file=sys.stderr)
+        for year, paths in doc_set['files'].items():
+            if len(paths) > 1:
+                print(f"  {doc_set['name']}: {year} from {len(paths)} volumes "
+                      f"({', '.join(os.path.basename(path) for path in paths)})")
+    if jobs > 1 and len(sets) > 1:
+        # One interpreter (and lxml) per worker, reused for every set it takes
+        with ProcessPoolExecutor(max_workers=min(jobs, len(sets))) as executor:
+            futures = [executor.submit(run_document_set, doc_set, out_dir, options) for doc_set in sets]
+            entries = []
+            for future in futures:
+                entries.append(future.result())
+                report_batch_entry(entries[-1])
+    else:
+        entries = []
+        for doc_set in sets:
+            entries.append(run_document_set(doc_set, out_dir, options))
+            report_batch_entry(entries[-1])
+    index = {'manifest': os.path.abspath(manifest_path), 'sets': entries}
+    with open(os.path.join(out_dir, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    failed = sum(1 for entry in entries if entry['status'] != 'ok')
+    print(f"✓ Generated {os.path.join(out_dir, 'index.json')} ({len(entries) - failed} ok, {failed} failed)")
+    return index
+
+def report_batch_entry(entry):
+    if entry['status'] == 'ok':
+        print(f"  {entry['name']}: {entry['total_paragraphs']} paragraphs -> {entry['output']} ({entry['seconds']} s)")
+    else:
+        print(f"  {entry['name']}: {entry['error']} (see {entry['log']})")
+
+class LazyComparisonSource:
+    """--serve: editions loaded and aligned once, paragraph entries built as the viewer requests them
+    
+    Alignment and note moves need the whole corpus, so they run up front (and again when an
+    edition file changes); unified texts and notes are built per requested paragraph.
+    """
+    prefix = 'comparison_provenance/'
+    
+    def __init__(self, files, stream=False, diff_engine='difflib', align='greedy', band=10, note_moves=True):
+        self.files = files
+        self.stream = stream
+        self.diff_engine = diff_engine
+        self.options = {'align': align, 'band': band, 'note_moves': note_moves}
+        self.mtimes = None
+        self.refresh()
+    
+    def refresh(self):
+        mtimes = {year: os.stat(path).st_mtime_ns for year, path in self.files.items()}
+        if mtimes == self.mtimes:
+            return
+        analyzer = FinalAnalyzerWithAlignedNotes(self.diff_engine)
+        load_editions(analyzer, self.files, self.stream)
+        self.work_units = analyzer.align(**self.options)
+        self.analyzer = analyzer
+        self.mtimes = mtimes
+        # Part of every content key, so entries of an earlier load are never reused
+        self.token = json.dumps([mtimes, self.diff_engine, self.options], sort_keys=True)
+    
+    def total(self):
+        return len(self.work_units)
+    
+    def manifest(self):
+        metadata = self.analyzer.make_output([], None, self.options['note_moves'])['metadata']
+        # Variant statistics need every paragraph, so the served manifest has none
+        del metadata['variant_statistics']
+        metadata['total_paragraphs'] = len(self.work_units)
+        if 'moved_notes' in metadata:
+            metadata['moved_notes'] = sum(
+                len(alignment.get('note_moves', {}).get('to', ())) for alignment, _, _ in self.work_units
+            )
+        return {
+            'metadata': metadata,
+            'toc': [
+                {'index': alignment['index'], 'new_in_1849': alignment.get('new_in_1849', False)}
+                for alignment, _, _ in self.work_units
+            ]
+        }
+    
+    def keys(self, start, end):
+        return [f'{self.token}:{idx}' for idx in range(start, end)]
+    
+    def build(self, idx):
+        result, _ = self.analyzer.process_alignment(*self.work_units[idx])
+        return result
 
 def main():
+    parser = argparse.ArgumentParser(description='Compare editions of Ansichten der Natur')
+    parser.add_argument('--stream', action='store_true',
+                        help='load TEI files with iterparse instead of keeping full trees in memory')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help='build unified texts in N worker processes, or with --batch analyze N '
+                             'document sets at a time (default: 1)')
+    parser.add_argument('--batch', metavar='MANIFEST',
+                        help='analyze the document sets of MANIFEST (a catalog.xml collection or a JSON list '
+                             'of sets) into OUT_DIR/<set>/ and write OUT_DIR/index.json')
+    parser.add_argument('--out-dir', default='batch', metavar='OUT_DIR',
+                        help='with --batch, directory for the per-set outputs and the index (default: batch)')
+    parser.add_argument('--shard-dir', metavar='DIR',
+                        help='write DIR/manifest.json plus paragraph shards instead of comparison_provenance.json')
+    parser.add_argument('--shard-size', type=int, default=50, metavar='N',
+                        help='paragraphs per shard (default: 50)')
+    parser.add_argument('--diff-engine', choices=list(ENGINES), default='difflib',
+                        help='token diff algorithm for unified texts; myers (also used by patience) '
+                             f'falls back to difflib matching past {MYERS_MAX_D} edits (default: difflib)')
+    parser.add_argument('--check-diff', action='store_true',
+                        help='validate every token diff and report how it compares with difflib')
+    parser.add_argument('--align', choices=['greedy', 'banded'], default='greedy',
+                        help='paragraph alignment: greedy best match, or order-preserving banded DP '
+                             'with 1:2 splits and 2:1 merges (default: greedy)')
+    parser.add_argument('--band', type=int, default=10, metavar='N',
+                        help='with --align banded, paragraphs considered on each side of the expected position (default: 10)')
+    parser.add_argument('--no-note-moves', dest='note_moves', action='store_false',
+                        help='align notes within each paragraph only, without looking for notes moved to another paragraph')
+    parser.add_argument('--serve', metavar='[HOST:]PORT',
+                        help='serve the current directory and build comparison_provenance/ shards on demand '
+                             'instead of writing output')
+    parser.add_argument('--serve-cache', type=int, default=2000, metavar='N',
+                        help='with --serve, built paragraphs kept in memory (default: 2000)')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='write per-stage wall/CPU time, tracemalloc peaks and the slowest paragraphs to PATH as JSON')
+    parser.add_argument('--profile-top', type=int, default=10, metavar='N',
+                        help='slowest paragraphs listed in the profile (default: 10)')
+    args = parser.parse_args()
+    if args.serve:
+        if args.batch or args.shard_dir or args.profile:
+            parser.error('--serve builds paragraphs on request; --batch, --shard-dir and --profile need a full run')
+        host, _, port = args.serve.rpartition(':')
+        source = LazyComparisonSource(find_edition_files(), args.stream, args.diff_engine,
+                                      args.align, args.band, args.note_moves)
+        slot_server.serve(source, host or '127.0.0.1', int(port),
+                          shard_size=args.shard_size, cache_size=args.serve_cache)
+        return
+    if args.batch:
+        if args.shard_dir or args.profile:
+            parser.error('--batch writes one comparison_provenance.json per set; '
+                         '--shard-dir and --profile need a single run')
+        try:
+            index = run_batch(args.batch, args.out_dir, jobs=args.jobs, stream=args.stream,
+                              diff_engine=args.diff_engine, check_diff=args.check_diff,
+                              align=args.align, band=args.band, note_moves=args.note_moves)
+        except (OSError, ValueError, etree.XMLSyntaxError) as e:
+            parser.error(str(e))
+        sys.exit(1 if any(entry['status'] != 'ok' for entry in index['sets']) else 0)
+    if args.check_diff and args.jobs > 1:
+        # Worker processes keep their own tallies, so checking runs in-process.
+        print("--check-diff: running with --jobs 1")
+        args.jobs = 1
+    if args.profile and args.jobs > 1:
+        print("--profile: running with --jobs 1")
+        args.jobs = 1
+    
     print("Humboldt Analysis with Note Similarity Scores")
     print("="*60)
     
-    analyzer = FinalAnalyzerWithAlignedNotes()
+    profiler = StageProfiler(args.profile_top) if args.profile else None
+    analyzer = FinalAnalyzerWithAlignedNotes(args.diff_engine, args.check_diff, profiler)
+    if profiler is not None:
+        profiler.start()
     
-    files = {}
-    for path in Path('.').glob('*.xml'):
-        name = path.name.lower()
-        if '1808' in name:
-            files['1808'] = str(path)
-        elif '1826' in name:
-            files['1826'] = str(path)
-        elif '1849' in name:
-            files['1849'] = str(path)
+    load_editions(analyzer, find_edition_files(), args.stream)
     
-    for year, filepath in files.items():
-        if filepath:
-            analyzer.load_tei(filepath, year)
+    analyzer.analyze(jobs=args.jobs, shard_dir=args.shard_dir, shard_size=args.shard_size,
+                     align=args.align, band=args.band, note_moves=args.note_moves)
     
-    analyzer.analyze()
+    if profiler is not None:
+        profiler.stop()
+        profiler.write(args.profile)
+        print(f"\nProfile ({args.profile}):")
+        print(profiler.summary())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,64 @@
+"""MinHash signatures and LSH banding for matching notes across the whole corpus.
+
+A note is represented by the set of its word 2-grams (lowercase). MinHasher turns
+that set into a signature of num_perm minimum hash values; two signatures agree
+in a position with a probability that approximates the Jaccard similarity of the
+sets (XOR masks are not truly random permutations).
+LSHIndex cuts signatures into bands of rows values and files each band in a
+bucket, so notes sharing any band become candidates without comparing every pair.
+
+With 32 bands of 2 rows, a pair with shingle Jaccard 0.25 becomes a candidate
+with probability 0.87, one with 0.03 (unrelated notes of the editions) with 0.03.
+Candidates are meant to be verified with the exact similarity.
+"""
+import random
+import re
+import zlib
+
+WORD_RE = re.compile(r'\w+')
+MAX_HASH = (1 << 32) - 1
+
+def shingles(text, k=2):
+    """Set of lowercase word k-grams of text, or of its words if it is shorter than k words"""
+    words = WORD_RE.findall(text.lower())
+    if len(words) < k:
+        return set(words)
+    return {' '.join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+class MinHasher:
+    """MinHash over CRC-32 shingle hashes, one XOR mask per permutation"""
+
+    def __init__(self, num_perm=64, seed=1808):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.masks = [rng.getrandbits(32) for _ in range(num_perm)]
+
+    def signature(self, text):
+        """Signature of text as a tuple of num_perm values, or None if it has no words"""
+        hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text)]
+        if not hashes:
+            return None
+        return tuple(min(map(mask.__xor__, hashes)) for mask in self.masks)
+
+class LSHIndex:
+    """Buckets of keys by signature band"""
+
+    def __init__(self, bands=32, rows=2):
+        self.bands = bands
+        self.rows = rows
+        self.buckets = [{} for _ in range(bands)]
+
+    def band_keys(self, signature):
+        rows = self.rows
+        return [tuple(signature[b * rows:(b + 1) * rows]) for b in range(self.bands)]
+
+    def add(self, key, signature):
+        for bucket, band in zip(self.buckets, self.band_keys(signature)):
+            bucket.setdefault(band, []).append(key)
+
+    def candidates(self, signature):
+        """Keys sharing at least one band with signature"""
+        found = set()
+        for bucket, band in zip(self.buckets, self.band_keys(signature)):
+            found.update(bucket.get(band, ()))
+        return found
@@ -0,0 +1,197 @@
+"""Stage benchmark for vm_to_slot.py.
+
+Times parse, segment, stats and dump on a VM file and on synthetic exports built by
+replicating it, and writes the timings as JSON so runs from different commits can
+be compared:
+
+    python3 bench_vm_to_slot.py humboldt-vm-parallel-seg.xml --out bench-v2.json
+    python3 bench_vm_to_slot.py humboldt-vm-parallel-seg.xml --out bench-v2-new.json --baseline bench-v2.json
+
+A synthetic export of scale N holds N copies of the body. In copy k, about one word
+in eight of every literal and <rdg> is suffixed with k, and <l n> is renumbered.
+A word changes the same way in every reading, so the <app> structure is kept.
+
+Every run executes in a freshly spawned interpreter, so the char diff memo starts
+empty and max_rss_kb is the peak of that run alone, not of the whole benchmark.
+"""
+import argparse
+import copy as copying
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import vm_to_slot as v
+
+STAGES = ("parse", "segment", "stats", "dump")
+WORD_RE = re.compile(r"\w+")
+
+def mutate_words(text: str, copy: int) -> str:
+    # Same word, same mutation in every reading, so copies keep the <app> structure.
+    if not text or not copy:
+        return text
+    def mutate(match):
+        word = match.group()
+        return f"{word}{copy}" if zlib.crc32(f"{copy}:{word}".encode("utf-8")) % 8 == 0 else word
+    return WORD_RE.sub(mutate, text)
+
+def write_scaled_vm(src: str, dst: str, scale: int):
+    ET.register_namespace("", v.NS["tei"])
+    tree = ET.parse(src)
+    body = tree.getroot().find(".//tei:body", v.NS)
+    originals = list(body)
+    l_tag = f"{{{v.NS['tei']}}}l"
+    count = sum(1 for _ in body.iter(l_tag))
+    for copy in range(1, scale):
+        for child in originals:
+            clone = copying.deepcopy(child)
+            for elem in clone.iter():
+                num = elem.get("n") if elem.tag == l_tag else None
+                if num and num.isdigit():
+                    elem.set("n", str(int(num) + copy * count))
+                elem.text = mutate_words(elem.text, copy)
+                elem.tail = mutate_words(elem.tail, copy)
+            body.append(clone)
+    tree.write(dst, encoding="utf-8", xml_declaration=True)
+
+@contextmanager
+def timed(timings: Dict[str, float], stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def bench_export(xml_path: str) -> Dict:
+    v.configure_witnesses(xml_path)
+    # Repeats and scales must not reuse char diffs memoized by an earlier run.
+    v.char_diff_ops.cache_clear()
+    timings = {}
+    with timed(timings, "parse"):
+        l_elems = v.extract_l_elements(ET.parse(xml_path).getroot())
+
+    with timed(timings, "segment"):
+        segments = [v.build_segments_from_l(l) for l in l_elems]
+
+    with timed(timings, "stats"):
+        para_stats = [v.compute_para_stats(s) for s in segments]
+
+    with timed(timings, "dump"):
+        global_stats = v.new_global_stats()
+        content = []
+        for idx, (l, segs, stats) in enumerate(zip(l_elems, segments, para_stats)):
+            v.add_to_global(global_stats, stats)
+            global_stats["paragraphs"] += 1
+            content.append(v.make_slot_entry(idx, l, segs, stats))
+        meta = v.slot_meta()
+        meta["stats"] = global_stats
+        with open(os.devnull, "w", encoding="utf-8") as sink:
+            sink.write(v.json_dumps({"meta": meta, "content": content}, 2))
+
+    return {
+        "l_elements": len(l_elems),
+        "stages": {stage: round(timings[stage], 4) for stage in STAGES},
+        "total": round(sum(timings.values()), 4),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+def run_isolated(func, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(func, *args).result()
+
+def git_revision():
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=cwd, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=cwd,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+def compare_runs(baseline: Dict, report: Dict, threshold: float) -> int:
+    # Prints every stage against the baseline and returns the number of regressions.
+    old_runs = {run["scale"]: run for run in baseline["runs"]}
+    regressions = 0
+    print(f"\nagainst {baseline.get('commit') or 'baseline'} (regression: > {threshold:.0%} slower)")
+    for run in report["runs"]:
+        old = old_runs.get(run["scale"])
+        if old is None:
+            continue
+        for stage in STAGES + ("total",):
+            before = old["stages"].get(stage) if stage != "total" else old["total"]
+            after = run["stages"][stage] if stage != "total" else run["total"]
+            if not before:
+                continue
+            ratio = after / before
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {run['scale']:>4}x {stage:8s} {before:9.3f}s -> {after:9.3f}s  {ratio:5.2f}x{flag}")
+    return regressions
+
+def main(xml_path: str, scales: List[int], repeat: int, out_path: str, baseline_path: str = None,
+         threshold: float = 0.1) -> int:
+    commit, dirty = git_revision()
+    report = {
+        "tool": "vm_to_slot",
+        "commit": commit,
+        "dirty": dirty,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "input": os.path.basename(xml_path),
+        "diff_engine": v.DIFF_ENGINE,
+        "runs": []
+    }
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = xml_path
+            if scale > 1:
+                path = os.path.join(tmp, f"vm-x{scale}.xml")
+                write_scaled_vm(xml_path, path, scale)
+            runs = [run_isolated(bench_export, path) for _ in range(repeat)]
+        run = {"scale": scale, **min(runs, key=lambda r: r["total"])}
+        report["runs"].append(run)
+        stages = "  ".join(f"{stage} {run['stages'][stage]:.3f}s" for stage in STAGES)
+        print(f"{scale:>4}x  {run['l_elements']:7d} <l>  {stages}  total {run['total']:.3f}s")
+
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {out_path}")
+
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare_runs(baseline, report, threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of vm_to_slot.py.")
+    parser.add_argument("xml_path", metavar="vm_tei.xml")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], metavar="N",
+                        help="export sizes as multiples of the input (default: 1 10 100)")
+    parser.add_argument("--repeat", type=int, default=1, metavar="N",
+                        help="runs per scale; the fastest total is kept (default: 1)")
+    parser.add_argument("--out", default="bench-v2.json", metavar="PATH",
+                        help="write the JSON report to PATH (default: bench-v2.json)")
+    parser.add_argument("--baseline", metavar="PATH", help="compare with an earlier JSON report")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown counted as a regression (default: 0.1, i.e. 10%%)")
+    args = parser.parse_args()
+    sys.exit(main(args.xml_path, args.scales, args.repeat, args.out, args.baseline, args.threshold))
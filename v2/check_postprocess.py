@@ -0,0 +1,317 @@
+"""Golden check and micro-benchmark for vm_to_slot.postprocess_segments.
+
+Runs the original list passes (copied here from the baseline converter, on slot JSON
+dicts) and the streaming pipeline on the raw segments of every <l> in a VM file, fails
+if any result differs, and reports the per-<l> cost of both. It also checks that
+char_diff_ops's single-replace fast path gives the SequenceMatcher's ops, including
+replaced characters next to an equal one:
+
+    python3 check_postprocess.py humboldt-vm-parallel-seg.xml --repeat 5
+"""
+import argparse
+import copy
+import difflib
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+from typing import Dict, List
+
+import vm_to_slot as v
+
+# The original list passes, copied from the baseline converter (which kept segments as
+# slot JSON dicts), as a reference that shares no code with the streaming pipeline.
+
+def earliest(ed_list):
+    order = {e: i for i, e in enumerate(v.EDITIONS)}
+    return sorted(ed_list, key=lambda e: order.get(e, 99))[0]
+
+def coalesce_spans(spans: List[Dict]) -> List[Dict]:
+    if not spans:
+        return spans
+    out = [spans[0]]
+    for s in spans[1:]:
+        last = out[-1]
+        if (
+            s["type"] == last["type"]
+            and s["variant_type"] == last["variant_type"]
+            and s["editions"] == last["editions"]
+            and s["source"] == last["source"]
+            and s.get("changes", []) == last.get("changes", [])
+        ):
+            last["text"] += " " + s["text"]
+        else:
+            out.append(s)
+    return out
+
+def cleanup_punctuation(spans: List[Dict]) -> List[Dict]:
+    for s in spans:
+        s["text"] = re.sub(r"\s+([,.;:!?])", r"\1", s["text"])
+    return spans
+
+def trim_space_before_punct_spans(spans: List[Dict]) -> List[Dict]:
+    punct = set(",.;:!?")
+    for i, s in enumerate(spans):
+        txt = s.get("text", "")
+        if txt and all(ch in punct or ch.isspace() for ch in txt):
+            if i > 0:
+                spans[i - 1]["text"] = spans[i - 1]["text"].rstrip()
+            spans[i]["text"] = spans[i]["text"].lstrip()
+    return spans
+
+def token_level_merge_additions(a_span, b_span):
+    a_tokens = a_span["text"].split()
+    b_tokens = b_span["text"].split()
+    sm = difflib.SequenceMatcher(None, a_tokens, b_tokens)
+    out_spans = []
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        if tag == "equal":
+            toks = a_tokens[i1:i2]
+            if not toks:
+                continue
+            eds = sorted(set(a_span["editions"] + b_span["editions"]),
+                         key=lambda e: v.EDITIONS.index(e))
+            first = earliest(eds)
+            out_spans.append({
+                "text": " ".join(toks),
+                "type": f"added_in_{first}",
+                "variant_type": "addition",
+                "editions": eds,
+                "source": first,
+                "_first_added": first,
+                "changes": []
+            })
+        elif tag == "replace":
+            base_toks = a_tokens[i1:i2]
+            other_toks = b_tokens[j1:j2]
+            base_first = earliest(a_span["editions"])
+            out_spans.append({
+                "text": " ".join(base_toks),
+                "type": f"added_in_{base_first}",
+                "variant_type": "addition",
+                "editions": sorted(a_span["editions"], key=lambda e: v.EDITIONS.index(e)),
+                "source": base_first,
+                "_first_added": base_first,
+                "changes": [{
+                    "edition": b_span["editions"][0],
+                    "text": " ".join(other_toks),
+                    "char_level": [],
+                    "note": "Substitution (token-level)"
+                }]
+            })
+        elif tag == "delete":
+            base_toks = a_tokens[i1:i2]
+            if not base_toks:
+                continue
+            base_first = earliest(a_span["editions"])
+            out_spans.append({
+                "text": " ".join(base_toks),
+                "type": f"added_in_{base_first}",
+                "variant_type": "addition",
+                "editions": sorted(a_span["editions"], key=lambda e: v.EDITIONS.index(e)),
+                "source": base_first,
+                "_first_added": base_first,
+                "changes": []
+            })
+        elif tag == "insert":
+            ins_toks = b_tokens[j1:j2]
+            if not ins_toks:
+                continue
+            other_first = earliest(b_span["editions"])
+            out_spans.append({
+                "text": " ".join(ins_toks),
+                "type": f"added_in_{other_first}",
+                "variant_type": "addition",
+                "editions": sorted(b_span["editions"], key=lambda e: v.EDITIONS.index(e)),
+                "source": other_first,
+                "_first_added": other_first,
+                "changes": []
+            })
+    return out_spans
+
+def reconcile_conflicting_additions(spans: List[Dict]) -> List[Dict]:
+    out = []
+    i = 0
+    while i < len(spans):
+        if (
+            i + 1 < len(spans)
+            and spans[i].get("variant_type") == "addition"
+            and spans[i + 1].get("variant_type") == "addition"
+            and set(spans[i]["editions"]).isdisjoint(spans[i + 1]["editions"])
+        ):
+            merged = token_level_merge_additions(spans[i], spans[i + 1])
+            out.extend(merged)
+            i += 2
+            continue
+        out.append(spans[i])
+        i += 1
+    return out
+
+def split_replaced_tokenwise(spans: List[Dict]) -> List[Dict]:
+    out = []
+    for s in spans:
+        if not (s.get("type") == "replaced" and s.get("variant_type") == "substitution"):
+            out.append(s)
+            continue
+        if len(s.get("editions", [])) != 2 or len(s.get("changes", [])) != 1:
+            out.append(s)
+            continue
+        base_text = s["text"]
+        base_ed = s.get("source", v.BASE_EDITION) or v.BASE_EDITION
+        ch = s["changes"][0]
+        other_ed = ch["edition"]
+        other_text = ch["text"]
+        a_tokens = base_text.split()
+        b_tokens = other_text.split()
+        sm = difflib.SequenceMatcher(None, a_tokens, b_tokens)
+
+        new_spans = []
+        for tag, i1, i2, j1, j2 in sm.get_opcodes():
+            if tag == "equal":
+                toks = a_tokens[i1:i2]
+                if not toks:
+                    continue
+                eds = sorted([base_ed, other_ed], key=lambda e: v.EDITIONS.index(e))
+                first = earliest(eds)
+                new_spans.append({
+                    "text": " ".join(toks),
+                    "type": f"added_in_{first}",
+                    "variant_type": "addition",
+                    "editions": eds,
+                    "source": first,
+                    "_first_added": first,
+                    "changes": []
+                })
+            elif tag == "replace":
+                base_toks = a_tokens[i1:i2]
+                other_toks = b_tokens[j1:j2]
+                if base_toks:
+                    new_spans.append({
+                        "text": " ".join(base_toks),
+                        "type": f"added_in_{base_ed}",
+                        "variant_type": "addition",
+                        "editions": [base_ed],
+                        "source": base_ed,
+                        "_first_added": base_ed,
+                        "changes": [{
+                            "edition": other_ed,
+                            "text": " ".join(other_toks),
+                            "char_level": [],
+                            "note": "Substitution (token-level)"
+                        }]
+                    })
+            elif tag == "delete":
+                base_toks = a_tokens[i1:i2]
+                if base_toks:
+                    new_spans.append({
+                        "text": " ".join(base_toks),
+                        "type": f"added_in_{base_ed}",
+                        "variant_type": "addition",
+                        "editions": [base_ed],
+                        "source": base_ed,
+                        "_first_added": base_ed,
+                        "changes": []
+                    })
+            elif tag == "insert":
+                ins_toks = b_tokens[j1:j2]
+                if ins_toks:
+                    new_spans.append({
+                        "text": " ".join(ins_toks),
+                        "type": f"added_in_{other_ed}",
+                        "variant_type": "addition",
+                        "editions": [other_ed],
+                        "source": other_ed,
+                        "_first_added": other_ed,
+                        "changes": []
+                    })
+        out.extend(new_spans if new_spans else [s])
+    return out
+
+def add_word_boundaries(spans: List[Dict]) -> List[Dict]:
+    def wordy(text: str) -> bool:
+        return bool(text) and text[0].isalnum()
+    for i in range(len(spans) - 1):
+        a, b = spans[i], spans[i + 1]
+        if not a["text"].endswith(" ") and not b["text"].startswith(" "):
+            if wordy(a["text"]) and wordy(b["text"]):
+                a["text"] += " "
+    return spans
+
+def postprocess_multipass(segments):
+    segments = [s for s in segments if s["text"]]
+    segments = coalesce_spans(segments)
+    segments = cleanup_punctuation(segments)
+    segments = trim_space_before_punct_spans(segments)
+    segments = reconcile_conflicting_additions(segments)
+    segments = coalesce_spans(segments)
+    segments = split_replaced_tokenwise(segments)
+    segments = coalesce_spans(segments)
+    segments = add_word_boundaries(segments)
+    return segments
+
+# (base, other) readings whose char ops must not depend on the single_replace fast path.
+CHAR_DIFF_CASES = [
+    ("abc", "axc"), ("Strasse", "Straße"), ("Baeume", "Bäume"), ("ub", "bb"), ("bäa", "baea"),
+]
+
+def sequence_matcher_ops(base_text: str, other_text: str):
+    # char_diff_ops without the fast path and the length ceiling.
+    ops = []
+    sm = difflib.SequenceMatcher(None, base_text, other_text)
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        if tag == "replace":
+            ops.append((i1, "replace", other_text[j1:j2], base_text[i1:i2]))
+        elif tag == "delete":
+            ops.append((i1, "delete", base_text[i1:i2], base_text[i1:i2]))
+        elif tag == "insert":
+            ops.append((i1, "insert", other_text[j1:j2], ""))
+    return tuple(ops)
+
+def best_time(func, raw, repeat):
+    # Both implementations mutate their input, so each run gets fresh copies (not timed).
+    best = None
+    for _ in range(repeat):
+        inputs = copy.deepcopy(raw)
+        start = time.perf_counter()
+        for segments in inputs:
+            func(segments)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(xml_path: str, repeat: int) -> int:
+    v.configure_witnesses(xml_path)
+    root = ET.parse(xml_path).getroot()
+    raw = [v.build_raw_segments(l) for l in v.extract_l_elements(root)]
+
+    raw_json = [[s.to_json() for s in segments] for segments in raw]
+
+    mismatches = [
+        idx for idx, (segments, dicts) in enumerate(zip(raw, raw_json))
+        if postprocess_multipass(copy.deepcopy(dicts))
+        != [s.to_json() for s in v.postprocess_segments(copy.deepcopy(segments))]
+    ]
+    for idx in mismatches[:10]:
+        print(f"mismatch in <l> #{idx}", file=sys.stderr)
+    char_mismatches = [
+        case for case in CHAR_DIFF_CASES if v.char_diff_ops(*case) != sequence_matcher_ops(*case)
+    ]
+    for base_text, other_text in char_mismatches:
+        print(f"char ops mismatch: {base_text!r} -> {other_text!r}", file=sys.stderr)
+
+    multipass = best_time(postprocess_multipass, raw_json, repeat)
+    streaming = best_time(v.postprocess_segments, raw, repeat)
+    n = len(raw) or 1
+    print(f"{len(raw)} <l>, {len(mismatches)} mismatches; "
+          f"{len(CHAR_DIFF_CASES)} char diff cases, {len(char_mismatches)} mismatches")
+    print(f"list passes: {multipass * 1e6 / n:8.1f} µs/<l>")
+    print(f"streaming:   {streaming * 1e6 / n:8.1f} µs/<l> ({multipass / streaming:.2f}x)")
+    return 1 if mismatches or char_mismatches else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare streaming post-processing with the list passes.")
+    parser.add_argument("xml_path", metavar="vm_tei.xml")
+    parser.add_argument("--repeat", type=int, default=5, metavar="N",
+                        help="timing runs per implementation; the best is reported (default: 5)")
+    args = parser.parse_args()
+    sys.exit(main(args.xml_path, args.repeat))
@@ -0,0 +1,253 @@
+"""Typography sidecar: offsets of typographic features per <l n>, read from the source TEI.
+
+LERA imports typography (@rendition on <hi> etc.) but does not export it, so the VM
+export and the slot JSON only carry plain text. This script walks the step3 TEI of
+each witness (data-preparation/output/step3, several volumes in filename order),
+records the character span of every @rendition value, aligns the witness's tokens
+with the witness text that vm_to_slot.py reconstructs for each <l>, and writes the
+spans as (l n, char start, char end, feature code) records:
+
+    python3 typography_sidecar.py humboldt-vm-parallel-seg.xml ../data-preparation/output/step3 --out typography.bin
+    python3 typography_sidecar.py --show 13 typography.bin
+
+Offsets are code points into project_editions(segments)[witness], i.e. into the
+witness's text of the <l> as the concatenated slot segments give it. Spans over
+tokens that are missing from the export are dropped; a span broken by such a token
+becomes several records.
+
+File layout (little-endian), built for mmap without any parsing beyond the header:
+
+    header    "HTYP", u16 version, u16 witnesses, u16 features, u16 0, u32 records
+    witnesses 16-byte id (UTF-8, NUL-padded), u32 first record, u32 record count
+    features  16-byte name, e.g. "g" for rendition="#g" (code = position)
+    columns   u32 l_n[records], u32 start[records], u32 end[records], u8 feature[records]
+
+Records are sorted by witness, l n, start, so the records of one <l> are found by
+bisecting the witness's slice of the l_n column.
+"""
+import argparse
+import glob
+import mmap
+import os
+import re
+import struct
+import sys
+import xml.etree.ElementTree as ET
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Tuple
+
+import vm_to_slot as v
+from common.token_diff import get_diff_engine
+
+MAGIC = b"HTYP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHHHI")
+WITNESS_ENTRY = struct.Struct("<16sII")
+NAME_SIZE = 16
+TOKEN_RE = re.compile(r"\S+")
+
+# Elements inside running text; every other element ends a block and gets a space after it.
+INLINE_TAGS = {"hi", "foreign", "unclear", "space", "lb", "pb", "choice", "sic", "corr", "abbr", "expan",
+               "g", "name", "persName", "placeName", "note"}
+
+Record = Tuple[int, int, int, int]
+
+def local_name(tag) -> str:
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+def read_tei_stream(paths: List[str]) -> Tuple[str, List[Tuple[int, int, str]]]:
+    # Text of the TEI files (NFC) and the (start, end, feature) span of each @rendition value.
+    parts: List[str] = []
+    spans: List[Tuple[int, int, str]] = []
+    length = 0
+
+    def add(text):
+        nonlocal length
+        if text:
+            text = v.nfc(text)
+            parts.append(text)
+            length += len(text)
+
+    def walk(elem):
+        start = length
+        add(elem.text)
+        for child in elem:
+            if isinstance(child.tag, str):
+                walk(child)
+            add(child.tail)
+        if local_name(elem.tag) not in INLINE_TAGS:
+            add(" ")
+        for value in (elem.get("rendition") or "").split():
+            if length > start:
+                spans.append((start, length, value.lstrip("#")))
+
+    for path in paths:
+        walk(ET.parse(path).getroot())
+        add(" ")
+    return "".join(parts), spans
+
+def token_bounds(text: str) -> Tuple[List[str], array, array]:
+    tokens, starts, ends = [], array("I"), array("I")
+    for match in TOKEN_RE.finditer(text):
+        tokens.append(match.group())
+        starts.append(match.start())
+        ends.append(match.end())
+    return tokens, starts, ends
+
+def witness_records(tei_paths: List[str], l_texts: List[Tuple[int, str]],
+                    features: Dict[str, int], diff=get_diff_engine("difflib")) -> Tuple[List[Record], float]:
+    # Records of one witness and the share of its export tokens matched in the TEI.
+    text, spans = read_tei_stream(tei_paths)
+    tei_tokens, tei_starts, tei_ends = token_bounds(text)
+
+    vm_tokens: List[str] = []
+    vm_l = array("I")
+    vm_starts = array("I")
+    for n, l_text in l_texts:
+        tokens, starts, _ = token_bounds(l_text)
+        vm_tokens.extend(tokens)
+        vm_l.extend([n] * len(tokens))
+        vm_starts.extend(starts)
+
+    # TEI token -> export token, for tokens in equal runs (same text, so same in-token offsets)
+    matched = {}
+    for tag, i1, i2, j1, j2 in diff(tei_tokens, vm_tokens):
+        if tag == "equal":
+            for k in range(i2 - i1):
+                matched[i1 + k] = j1 + k
+
+    records: List[Record] = []
+    for start, end, name in spans:
+        code = features.setdefault(name, len(features))
+        run = None
+        for t in range(bisect_right(tei_ends, start), bisect_left(tei_starts, end)):
+            j = matched.get(t)
+            if j is None:
+                if run:
+                    records.append(run)
+                run = None
+                continue
+            piece_start = vm_starts[j] + max(start, tei_starts[t]) - tei_starts[t]
+            piece_end = vm_starts[j] + min(end, tei_ends[t]) - tei_starts[t]
+            if run and run[0] == vm_l[j] and matched.get(t - 1) == j - 1:
+                run = (run[0], run[1], piece_end, code)
+            else:
+                if run:
+                    records.append(run)
+                run = (vm_l[j], piece_start, piece_end, code)
+        if run:
+            records.append(run)
+    records.sort()
+    return records, len(matched) / len(vm_tokens) if vm_tokens else 1.0
+
+def write_sidecar(path: str, by_witness: Dict[str, List[Record]], features: Dict[str, int]):
+    names = sorted(features, key=features.get)
+    header = [HEADER.pack(MAGIC, VERSION, len(by_witness), len(names), 0,
+                          sum(len(r) for r in by_witness.values()))]
+    columns = [array("I"), array("I"), array("I"), array("B")]
+    for witness, records in by_witness.items():
+        header.append(WITNESS_ENTRY.pack(witness.encode("utf-8"), len(columns[0]), len(records)))
+        for record in records:
+            for column, value in zip(columns, record):
+                column.append(value)
+    header.extend(struct.pack(f"{NAME_SIZE}s", name.encode("utf-8")) for name in names)
+    if sys.byteorder == "big":
+        for column in columns:
+            column.byteswap()
+    with open(path, "wb") as f:
+        f.write(b"".join(header))
+        for column in columns:
+            f.write(column.tobytes())
+
+class TypographySidecar:
+    # Read-only view of a sidecar file; the columns are memoryviews of the mapped file.
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_witnesses, n_features, _, n_records = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a typography sidecar (version {VERSION})")
+        pos = HEADER.size
+        self.witnesses: Dict[str, Tuple[int, int]] = {}
+        for _ in range(n_witnesses):
+            name, first, count = WITNESS_ENTRY.unpack_from(self.mm, pos)
+            self.witnesses[name.rstrip(b"\0").decode("utf-8")] = (first, count)
+            pos += WITNESS_ENTRY.size
+        self.features = [
+            self.mm[pos + i * NAME_SIZE:pos + (i + 1) * NAME_SIZE].rstrip(b"\0").decode("utf-8")
+            for i in range(n_features)
+        ]
+        pos += n_features * NAME_SIZE
+        view = memoryview(self.mm)
+        columns = []
+        for fmt, size in (("I", 4), ("I", 4), ("I", 4), ("B", 1)):
+            column = view[pos:pos + n_records * size].cast(fmt)
+            if sys.byteorder == "big" and size > 1:
+                column = array(fmt, column)
+                column.byteswap()
+            columns.append(column)
+            pos += n_records * size
+        self.l_n, self.start, self.end, self.feature = columns
+
+    def spans(self, witness: str, n: int) -> List[Tuple[int, int, str]]:
+        # (start, end, feature name) of the <l n> in the witness's reconstructed text.
+        first, count = self.witnesses.get(witness, (0, 0))
+        lo = bisect_left(self.l_n, n, first, first + count)
+        hi = bisect_right(self.l_n, n, lo, first + count)
+        return [(self.start[i], self.end[i], self.features[self.feature[i]]) for i in range(lo, hi)]
+
+    def close(self):
+        self.l_n = self.start = self.end = self.feature = None
+        self.mm.close()
+
+def witness_files(tei_dir: str, witness: str) -> List[str]:
+    return sorted(p for p in glob.glob(os.path.join(tei_dir, "*.xml")) if witness in os.path.basename(p))
+
+def build_sidecar(xml_path: str, tei_dir: str, out_path: str) -> Dict[str, List[Record]]:
+    v.configure_witnesses(xml_path)
+    l_texts: Dict[str, List[Tuple[int, str]]] = {ed: [] for ed in v.EDITIONS}
+    for l_elem in v.extract_l_elements(ET.parse(xml_path).getroot()):
+        num = l_elem.get("n")
+        if not (num and num.isdigit()):
+            continue
+        for ed, text in v.project_editions(v.build_segments_from_l(l_elem)).items():
+            l_texts[ed].append((int(num), text))
+
+    features: Dict[str, int] = {}
+    by_witness = {}
+    for ed in v.EDITIONS:
+        paths = witness_files(tei_dir, ed)
+        if not paths:
+            print(f"{ed}: no TEI file in {tei_dir}", file=sys.stderr)
+            continue
+        records, coverage = witness_records(paths, l_texts[ed], features)
+        by_witness[ed] = records
+        print(f"{ed}: {len(records)} spans, {coverage:.0%} of export tokens found in "
+              f"{', '.join(os.path.basename(p) for p in paths)}", file=sys.stderr)
+    if len(features) > 256:
+        raise ValueError(f"{len(features)} features do not fit the u8 feature column")
+    write_sidecar(out_path, by_witness, features)
+    print(f"wrote {out_path} ({os.path.getsize(out_path)} bytes, features: {', '.join(features)})",
+          file=sys.stderr)
+    return by_witness
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build (or inspect) the typography offset sidecar.")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="vm_tei.xml and the step3 TEI directory, or with --show the sidecar file")
+    parser.add_argument("--out", default="typography.bin", metavar="PATH",
+                        help="sidecar file to write (default: typography.bin)")
+    parser.add_argument("--show", type=int, metavar="N", help="print the spans of <l n=N> per witness")
+    args = parser.parse_args()
+    if args.show is not None:
+        if len(args.paths) != 1:
+            parser.error("--show takes the sidecar file only")
+        sidecar = TypographySidecar(args.paths[0])
+        for witness in sidecar.witnesses:
+            print(witness, sidecar.spans(witness, args.show))
+        sidecar.close()
+    else:
+        if len(args.paths) != 2:
+            parser.error("expected vm_tei.xml and the step3 TEI directory")
+        build_sidecar(args.paths[0], args.paths[1], args.out)
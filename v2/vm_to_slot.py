@@ -1,16 +1,106 @@
+import argparse
+import hashlib
 import json
+import os
+import sqlite3
 import sys
 import unicodedata
 import difflib
 import re
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
 from typing import Dict, List, Tuple
 
+# token_diff, stage_profile and slot_server are shared with v1 and live in ../common.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    from common import slot_server
+    from common.stage_profile import StageProfiler
+    from common.token_diff import ENGINES, MYERS_MAX_D, get_diff_engine
+except ImportError as exc:
+    sys.exit(f"vm_to_slot.py needs the common/ directory next to v2/ ({exc})")
+
 NS = {"tei": "http://www.tei-c.org/ns/1.0"}
+XML_ID = "{http://www.w3.org/XML/1998/namespace}id"
+
+# Bump whenever the segments or stats produced for an <l> change, so cached results are rebuilt.
+CONVERTER_VERSION = "3"
+
+# Segment type codes: ADDED + i is "added_in_" + EDITIONS[i].
+ORIGINAL = 0
+REPLACED = 1
+ADDED = 2
+
+def set_editions(editions: List[str], base: str):
+    # Witnesses in chronological order, so "earliest" picks first-use correctly. Segment
+    # edition sets are bitmasks over EDITIONS (bit i is EDITIONS[i]); EDITION_LISTS caches
+    # the chronological list written to JSON for each mask seen.
+    global EDITIONS, BASE_EDITION, EDITION_BITS, ALL_EDITIONS, EDITION_LISTS, SEGMENT_TYPES, VARIANT_TYPES
+    if len(set(editions)) != len(editions):
+        raise ValueError(f"duplicate witness in {','.join(editions)}")
+    if base not in editions:
+        raise ValueError(f"base witness {base!r} is not one of {','.join(editions)}")
+    EDITIONS = list(editions)
+    BASE_EDITION = base
+    EDITION_BITS = {e: 1 << i for i, e in enumerate(EDITIONS)}
+    ALL_EDITIONS = (1 << len(EDITIONS)) - 1
+    EDITION_LISTS = {ALL_EDITIONS: EDITIONS}
+    SEGMENT_TYPES = ["original", "replaced"] + [f"added_in_{e}" for e in EDITIONS]
+    VARIANT_TYPES = [None, "substitution"] + ["addition"] * len(EDITIONS)
+
+set_editions(["1808", "1826", "1849"], "1849")
+
+# Token diff engine for the token-level passes (see token_diff.py); part of the cache key.
+DIFF_ENGINE = "difflib"
+diff_opcodes = get_diff_engine(DIFF_ENGINE)
+
+# Readings longer than this (in characters) get token-level ops in char_level instead of
+# a character SequenceMatcher; 0 disables the ceiling. Part of the cache key.
+CHAR_DIFF_MAX_LEN = 500
+
+# StageProfiler for --profile; None when not profiling.
+PROFILER = None
+
+# Pairs the viewer renders inline (see README "Safe small pairs").
+SAFE_PAIRS = {
+    ("ß", "ss"), ("ss", "ß"),
+    ("ae", "ä"), ("ä", "ae"), ("oe", "ö"), ("ö", "oe"), ("ue", "ü"), ("ü", "ue"),
+    ("Ae", "Ä"), ("Ä", "Ae"), ("Oe", "Ö"), ("Ö", "Oe"), ("Ue", "Ü"), ("Ü", "Ue"),
+}
 
-BASE_EDITION = "1849"
-# Chronological order so "earliest" picks first-use correctly.
-EDITIONS = ["1808", "1826", "1849"]
+def set_diff_engine(name: str, check: bool = False):
+    global DIFF_ENGINE, diff_opcodes
+    DIFF_ENGINE = name
+    diff_opcodes = get_diff_engine(name, check)
+    char_diff_ops.cache_clear()
+    return diff_opcodes
+
+def set_char_diff_max_len(max_len: int):
+    global CHAR_DIFF_MAX_LEN
+    CHAR_DIFF_MAX_LEN = max_len
+    char_diff_ops.cache_clear()
+
+def set_profiler(profiler):
+    global PROFILER
+    PROFILER = profiler
+
+def profile_stage(name: str):
+    return PROFILER.stage(name) if PROFILER is not None else nullcontext()
+
+def init_worker(diff_engine: str, char_diff_max_len: int, editions: List[str], base: str):
+    set_editions(editions, base)
+    set_diff_engine(diff_engine)
+    set_char_diff_max_len(char_diff_max_len)
+
+def token_opcodes(a_tokens: List[str], b_tokens: List[str]):
+    # Interned ids compare faster than strings and give the same opcodes.
+    ids = {}
+    a_ids = [ids.setdefault(t, len(ids)) for t in a_tokens]
+    b_ids = [ids.setdefault(t, len(ids)) for t in b_tokens]
+    with profile_stage("token diff"):
+        return diff_opcodes(a_ids, b_ids)
 
 def nfc(s: str) -> str:
     return unicodedata.normalize("NFC", s)
@@ -36,9 +126,67 @@ def normalize_literal(raw: str) -> str:
         s = s + " "
     return s
 
-def earliest(ed_list):
-    order = {e: i for i, e in enumerate(EDITIONS)}
-    return sorted(ed_list, key=lambda e: order.get(e, 99))[0]
+def edition_mask(ed_list) -> int:
+    mask = 0
+    for e in ed_list:
+        mask |= EDITION_BITS[e]
+    return mask
+
+def editions_of(mask: int) -> List[str]:
+    eds = EDITION_LISTS.get(mask)
+    if eds is None:
+        eds = EDITION_LISTS[mask] = [e for e in EDITIONS if mask & EDITION_BITS[e]]
+    return eds
+
+def earliest(mask: int) -> str:
+    return EDITIONS[(mask & -mask).bit_length() - 1]
+
+class Segment:
+    # One span of unified text. Only to_json builds the slot JSON dict, so the passes
+    # below work on integer edition masks and type codes.
+    __slots__ = ("text", "kind", "editions", "source", "changes")
+
+    def __init__(self, text: str, kind: int, editions: int, source: str, changes=()):
+        self.text = text
+        self.kind = kind
+        self.editions = editions
+        self.source = source
+        self.changes = changes
+
+    @property
+    def type(self) -> str:
+        return SEGMENT_TYPES[self.kind]
+
+    @property
+    def variant_type(self):
+        return VARIANT_TYPES[self.kind]
+
+    def __eq__(self, other):
+        if not isinstance(other, Segment):
+            return NotImplemented
+        return (self.text, self.kind, self.editions, self.source, self.changes) == \
+            (other.text, other.kind, other.editions, other.source, other.changes)
+
+    def __repr__(self):
+        return f"Segment({self.text!r}, {self.type}, {editions_of(self.editions)})"
+
+    def to_json(self) -> Dict:
+        data = {
+            "text": self.text,
+            "type": SEGMENT_TYPES[self.kind],
+            "variant_type": VARIANT_TYPES[self.kind],
+            "editions": editions_of(self.editions),
+            "source": self.source
+        }
+        if self.kind >= ADDED:
+            data["_first_added"] = self.source
+        data["changes"] = list(self.changes)
+        return data
+
+def added_segment(text: str, editions: int, changes=()) -> Segment:
+    # Additions are typed and sourced by the earliest edition that has them.
+    first = (editions & -editions).bit_length() - 1
+    return Segment(text, ADDED + first, editions, EDITIONS[first], changes)
 
 def classify_variant(texts: Dict[str, str]) -> Tuple[str, str, List[str]]:
     nonempty = [k for k, v in texts.items() if v]
@@ -50,277 +198,274 @@ def classify_variant(texts: Dict[str, str]) -> Tuple[str, str, List[str]]:
     if len(nonempty) == 1:
         e = nonempty[0]
         return (f"added_in_{e}", "addition", [e])
-    if texts.get(BASE_EDITION) and all((k == BASE_EDITION) or (texts[k] == "") for k in EDITIONS):
-        return (f"added_in_{BASE_EDITION}", "addition", [BASE_EDITION])
     return ("replaced", "substitution", nonempty)
 
-def coalesce_spans(spans: List[Dict]) -> List[Dict]:
-    if not spans:
-        return spans
-    out = [spans[0]]
-    for s in spans[1:]:
-        last = out[-1]
-        if (
-            s["type"] == last["type"]
-            and s["variant_type"] == last["variant_type"]
-            and s["editions"] == last["editions"]
-            and s["source"] == last["source"]
-            and s.get("changes", []) == last.get("changes", [])
-        ):
-            last["text"] += " " + s["text"]
+def same_span(a: Segment, b: Segment) -> bool:
+    return a.kind == b.kind and a.editions == b.editions and a.source == b.source and a.changes == b.changes
+
+# Segment post-processing as one streaming pipeline of generator stages; the original list
+# passes live on in check_postprocess.py as its reference.
+SPACE_BEFORE_PUNCT_RE = re.compile(r"\s+(?=[,.;:!?])")
+PUNCT_ONLY_RE = re.compile(r"[,.;:!?\s]+")
+
+def coalesced_spans(spans):
+    last = None
+    for s in spans:
+        if last is not None and same_span(s, last):
+            last.text += " " + s.text
+            continue
+        if last is not None:
+            yield last
+        last = s
+    if last is not None:
+        yield last
+
+def tidied_punctuation(spans):
+    # cleanup_punctuation + trim_space_before_punct_spans; a span is held back until the
+    # next one has been seen, since a punctuation-only successor right-strips it.
+    prev = None
+    for s in spans:
+        s.text = SPACE_BEFORE_PUNCT_RE.sub("", s.text)
+        if s.text and PUNCT_ONLY_RE.fullmatch(s.text):
+            if prev is not None:
+                prev.text = prev.text.rstrip()
+            s.text = s.text.lstrip()
+        if prev is not None:
+            yield prev
+        prev = s
+    if prev is not None:
+        yield prev
+
+def reconciled_additions(spans):
+    pending = None
+    for s in spans:
+        if pending is None:
+            pending = s
+        elif conflicting_additions(pending, s):
+            yield from token_level_merge_additions(pending, s)
+            pending = None
         else:
-            out.append(s)
-    return out
+            yield pending
+            pending = s
+    if pending is not None:
+        yield pending
 
-def cleanup_punctuation(spans: List[Dict]) -> List[Dict]:
+def replaced_split_tokenwise(spans):
     for s in spans:
-        s["text"] = re.sub(r"\s+([,.;:!?])", r"\1", s["text"])
-    return spans
-
-def trim_space_before_punct_spans(spans: List[Dict]) -> List[Dict]:
-    punct = set(",.;:!?")
-    for i, s in enumerate(spans):
-        txt = s.get("text", "")
-        if txt and all(ch in punct or ch.isspace() for ch in txt):
-            if i > 0:
-                spans[i - 1]["text"] = spans[i - 1]["text"].rstrip()
-            spans[i]["text"] = spans[i]["text"].lstrip()
-    return spans
-
-def add_word_boundaries(spans: List[Dict]) -> List[Dict]:
-    def wordy(text: str) -> bool:
-        return bool(text) and text[0].isalnum()
-    for i in range(len(spans) - 1):
-        a, b = spans[i], spans[i + 1]
-        if not a["text"].endswith(" ") and not b["text"].startswith(" "):
-            if wordy(a["text"]) and wordy(b["text"]):
-                a["text"] += " "
-    return spans
+        yield from split_replaced_span(s)
+
+def with_word_boundaries(spans):
+    prev = None
+    for s in spans:
+        if prev is not None:
+            a, b = prev.text, s.text
+            if not a.endswith(" ") and not b.startswith(" ") and a and a[0].isalnum() and b and b[0].isalnum():
+                prev.text += " "
+            yield prev
+        prev = s
+    if prev is not None:
+        yield prev
+
+def postprocess_segments(segments: List[Segment]) -> List[Segment]:
+    spans = (s for s in segments if s.text)
+    spans = tidied_punctuation(coalesced_spans(spans))
+    spans = coalesced_spans(reconciled_additions(spans))
+    spans = coalesced_spans(replaced_split_tokenwise(spans))
+    return list(with_word_boundaries(spans))
+
+def read_witnesses(xml_path: str) -> List[str]:
+    # Witness ids from <listWit> in document order; parsing stops at the end of the list
+    # (or at <body>), so the rest of the export is never read.
+    witness_tag = f"{{{NS['tei']}}}witness"
+    list_tag = f"{{{NS['tei']}}}listWit"
+    body_tag = f"{{{NS['tei']}}}body"
+    witnesses = []
+    for event, elem in ET.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            if elem.tag == body_tag:
+                break
+        elif elem.tag == witness_tag and elem.get(XML_ID):
+            witnesses.append(elem.get(XML_ID))
+        elif elem.tag == list_tag:
+            break
+    return witnesses
+
+def configure_witnesses(xml_path: str, witnesses: List[str] = None, base: str = None):
+    # Explicit witnesses override <listWit>; the base defaults to the latest witness.
+    editions = witnesses or read_witnesses(xml_path) or EDITIONS
+    set_editions(editions, base or editions[-1])
 
 def extract_l_elements(root):
     return root.findall(".//tei:body//tei:l", NS)
 
-def char_level_diff(base_text: str, other_text: str) -> List[Dict]:
+def single_replace(base_text: str, other_text: str):
+    # Trim the common prefix/suffix; a safe pair or one-character replace in between is
+    # emitted directly, as the SequenceMatcher would. If a replaced character equals a
+    # neighbour ("ub" -> "bb", "bäa" -> "baea"), the SequenceMatcher may place the edit
+    # elsewhere, so those go the slow path.
+    limit = min(len(base_text), len(other_text))
+    start = 0
+    while start < limit and base_text[start] == other_text[start]:
+        start += 1
+    end = 0
+    while end < limit - start and base_text[-1 - end] == other_text[-1 - end]:
+        end += 1
+    old = base_text[start:len(base_text) - end]
+    new = other_text[start:len(other_text) - end]
+    if not ((len(old) == 1 and len(new) == 1) or (old, new) in SAFE_PAIRS):
+        return None
+    neighbours = base_text[start - 1:start] + base_text[len(base_text) - end:][:1]
+    if any(c in neighbours for c in old + new):
+        return None
+    return ((start, "replace", new, old),)
+
+def token_char_ops(base_text: str, other_text: str):
+    # Token-level ops in char_level shape, for readings over CHAR_DIFF_MAX_LEN.
+    base_spans = [m.span() for m in re.finditer(r"\S+", base_text)]
+    other_spans = [m.span() for m in re.finditer(r"\S+", other_text)]
+    base_tokens = [base_text[a:b] for a, b in base_spans]
+    other_tokens = [other_text[a:b] for a, b in other_spans]
+    ops = []
+    for tag, i1, i2, j1, j2 in token_opcodes(base_tokens, other_tokens):
+        if tag == "equal":
+            continue
+        index = base_spans[i1][0] if i1 < len(base_spans) else len(base_text)
+        old = base_text[base_spans[i1][0]:base_spans[i2 - 1][1]] if i2 > i1 else ""
+        new = other_text[other_spans[j1][0]:other_spans[j2 - 1][1]] if j2 > j1 else ""
+        if tag == "replace":
+            ops.append((index, "replace", new, old))
+        elif tag == "delete":
+            ops.append((index, "delete", old, old))
+        elif tag == "insert":
+            ops.append((index, "insert", new, ""))
+    return tuple(ops)
+
+@lru_cache(maxsize=4096)
+def char_diff_ops(base_text: str, other_text: str):
+    fast = single_replace(base_text, other_text)
+    if fast is not None:
+        return fast
+    if CHAR_DIFF_MAX_LEN and max(len(base_text), len(other_text)) > CHAR_DIFF_MAX_LEN:
+        return token_char_ops(base_text, other_text)
     ops = []
     sm = difflib.SequenceMatcher(None, base_text, other_text)
     for tag, i1, i2, j1, j2 in sm.get_opcodes():
         if tag == "equal":
             continue
         if tag == "replace":
-            ops.append({
-                "char_index": i1,
-                "operation": "replace",
-                "char": other_text[j1:j2],
-                "from": base_text[i1:i2]
-            })
+            ops.append((i1, "replace", other_text[j1:j2], base_text[i1:i2]))
         elif tag == "delete":
-            ops.append({
-                "char_index": i1,
-                "operation": "delete",
-                "char": base_text[i1:i2],
-                "from": base_text[i1:i2]
-            })
+            ops.append((i1, "delete", base_text[i1:i2], base_text[i1:i2]))
         elif tag == "insert":
-            ops.append({
-                "char_index": i1,
-                "operation": "insert",
-                "char": other_text[j1:j2],
-                "from": ""
-            })
-    return ops
-
-def token_level_merge_additions(a_span, b_span):
-    a_tokens = a_span["text"].split()
-    b_tokens = b_span["text"].split()
-    sm = difflib.SequenceMatcher(None, a_tokens, b_tokens)
+            ops.append((i1, "insert", other_text[j1:j2], ""))
+    return tuple(ops)
+
+def char_level_diff(base_text: str, other_text: str) -> List[Dict]:
+    # Memoized as tuples; fresh dicts per call so segments never share op objects.
+    with profile_stage("char diff"):
+        ops = char_diff_ops(base_text, other_text)
+    return [
+        {"char_index": index, "operation": operation, "char": char, "from": old}
+        for index, operation, char, old in ops
+    ]
+
+def token_level_merge_additions(a_span: Segment, b_span: Segment) -> List[Segment]:
+    a_tokens = a_span.text.split()
+    b_tokens = b_span.text.split()
     out_spans = []
-    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+    for tag, i1, i2, j1, j2 in token_opcodes(a_tokens, b_tokens):
         if tag == "equal":
             toks = a_tokens[i1:i2]
             if not toks:
                 continue
-            eds = sorted(set(a_span["editions"] + b_span["editions"]),
-                         key=lambda e: EDITIONS.index(e))
-            first = earliest(eds)
-            out_spans.append({
-                "text": " ".join(toks),
-                "type": f"added_in_{first}",
-                "variant_type": "addition",
-                "editions": eds,
-                "source": first,
-                "_first_added": first,
-                "changes": []
-            })
+            out_spans.append(added_segment(" ".join(toks), a_span.editions | b_span.editions))
         elif tag == "replace":
             base_toks = a_tokens[i1:i2]
             other_toks = b_tokens[j1:j2]
-            base_first = earliest(a_span["editions"])
-            out_spans.append({
-                "text": " ".join(base_toks),
-                "type": f"added_in_{base_first}",
-                "variant_type": "addition",
-                "editions": sorted(a_span["editions"], key=lambda e: EDITIONS.index(e)),
-                "source": base_first,
-                "_first_added": base_first,
-                "changes": [{
-                    "edition": b_span["editions"][0],
-                    "text": " ".join(other_toks),
-                    "char_level": [],
-                    "note": "Substitution (token-level)"
-                }]
-            })
+            out_spans.append(added_segment(" ".join(base_toks), a_span.editions, ({
+                "edition": earliest(b_span.editions),
+                "text": " ".join(other_toks),
+                "char_level": [],
+                "note": "Substitution (token-level)"
+            },)))
         elif tag == "delete":
             base_toks = a_tokens[i1:i2]
             if not base_toks:
                 continue
-            base_first = earliest(a_span["editions"])
-            out_spans.append({
-                "text": " ".join(base_toks),
-                "type": f"added_in_{base_first}",
-                "variant_type": "addition",
-                "editions": sorted(a_span["editions"], key=lambda e: EDITIONS.index(e)),
-                "source": base_first,
-                "_first_added": base_first,
-                "changes": []
-            })
+            out_spans.append(added_segment(" ".join(base_toks), a_span.editions))
         elif tag == "insert":
             ins_toks = b_tokens[j1:j2]
             if not ins_toks:
                 continue
-            other_first = earliest(b_span["editions"])
-            out_spans.append({
-                "text": " ".join(ins_toks),
-                "type": f"added_in_{other_first}",
-                "variant_type": "addition",
-                "editions": sorted(b_span["editions"], key=lambda e: EDITIONS.index(e)),
-                "source": other_first,
-                "_first_added": other_first,
-                "changes": []
-            })
+            out_spans.append(added_segment(" ".join(ins_toks), b_span.editions))
     return out_spans
 
-def reconcile_conflicting_additions(spans: List[Dict]) -> List[Dict]:
-    out = []
-    i = 0
-    while i < len(spans):
-        if (
-            i + 1 < len(spans)
-            and spans[i].get("variant_type") == "addition"
-            and spans[i + 1].get("variant_type") == "addition"
-            and set(spans[i]["editions"]).isdisjoint(spans[i + 1]["editions"])
-        ):
-            merged = token_level_merge_additions(spans[i], spans[i + 1])
-            out.extend(merged)
-            i += 2
-            continue
-        out.append(spans[i])
-        i += 1
-    return out
+def conflicting_additions(a: Segment, b: Segment) -> bool:
+    return a.kind >= ADDED and b.kind >= ADDED and not a.editions & b.editions
 
-def split_replaced_tokenwise(spans: List[Dict]) -> List[Dict]:
-    out = []
-    for s in spans:
-        if not (s.get("type") == "replaced" and s.get("variant_type") == "substitution"):
-            out.append(s)
-            continue
-        if len(s.get("editions", [])) != 2 or len(s.get("changes", [])) != 1:
-            out.append(s)
-            continue
-        base_text = s["text"]
-        base_ed = s.get("source", BASE_EDITION) or BASE_EDITION
-        ch = s["changes"][0]
-        other_ed = ch["edition"]
-        other_text = ch["text"]
-        a_tokens = base_text.split()
-        b_tokens = other_text.split()
-        sm = difflib.SequenceMatcher(None, a_tokens, b_tokens)
-
-        new_spans = []
-        for tag, i1, i2, j1, j2 in sm.get_opcodes():
-            if tag == "equal":
-                toks = a_tokens[i1:i2]
-                if not toks:
-                    continue
-                eds = sorted([base_ed, other_ed], key=lambda e: EDITIONS.index(e))
-                first = earliest(eds)
-                new_spans.append({
-                    "text": " ".join(toks),
-                    "type": f"added_in_{first}",
-                    "variant_type": "addition",
-                    "editions": eds,
-                    "source": first,
-                    "_first_added": first,
-                    "changes": []
-                })
-            elif tag == "replace":
-                base_toks = a_tokens[i1:i2]
-                other_toks = b_tokens[j1:j2]
-                if base_toks:
-                    new_spans.append({
-                        "text": " ".join(base_toks),
-                        "type": f"added_in_{base_ed}",
-                        "variant_type": "addition",
-                        "editions": [base_ed],
-                        "source": base_ed,
-                        "_first_added": base_ed,
-                        "changes": [{
-                            "edition": other_ed,
-                            "text": " ".join(other_toks),
-                            "char_level": [],
-                            "note": "Substitution (token-level)"
-                        }]
-                    })
-            elif tag == "delete":
-                base_toks = a_tokens[i1:i2]
-                if base_toks:
-                    new_spans.append({
-                        "text": " ".join(base_toks),
-                        "type": f"added_in_{base_ed}",
-                        "variant_type": "addition",
-                        "editions": [base_ed],
-                        "source": base_ed,
-                        "_first_added": base_ed,
-                        "changes": []
-                    })
-            elif tag == "insert":
-                ins_toks = b_tokens[j1:j2]
-                if ins_toks:
-                    new_spans.append({
-                        "text": " ".join(ins_toks),
-                        "type": f"added_in_{other_ed}",
-                        "variant_type": "addition",
-                        "editions": [other_ed],
-                        "source": other_ed,
-                        "_first_added": other_ed,
-                        "changes": []
-                    })
-        out.extend(new_spans if new_spans else [s])
-    return out
-
-def reconstruct_for_edition(segments: List[Dict], edition: str) -> str:
-    parts = []
+def split_replaced_span(s: Segment) -> List[Segment]:
+    if s.kind != REPLACED:
+        return [s]
+    if s.editions.bit_count() != 2 or len(s.changes) != 1:
+        return [s]
+    base_text = s.text
+    base_ed = s.source or BASE_EDITION
+    ch = s.changes[0]
+    other_ed = ch["edition"]
+    other_text = ch["text"]
+    base_bit = EDITION_BITS[base_ed]
+    other_bit = EDITION_BITS[other_ed]
+    a_tokens = base_text.split()
+    b_tokens = other_text.split()
+
+    new_spans = []
+    for tag, i1, i2, j1, j2 in token_opcodes(a_tokens, b_tokens):
+        if tag == "equal":
+            toks = a_tokens[i1:i2]
+            if not toks:
+                continue
+            new_spans.append(added_segment(" ".join(toks), base_bit | other_bit))
+        elif tag == "replace":
+            base_toks = a_tokens[i1:i2]
+            other_toks = b_tokens[j1:j2]
+            if base_toks:
+                new_spans.append(added_segment(" ".join(base_toks), base_bit, ({
+                    "edition": other_ed,
+                    "text": " ".join(other_toks),
+                    "char_level": [],
+                    "note": "Substitution (token-level)"
+                },)))
+        elif tag == "delete":
+            base_toks = a_tokens[i1:i2]
+            if base_toks:
+                new_spans.append(added_segment(" ".join(base_toks), base_bit))
+        elif tag == "insert":
+            ins_toks = b_tokens[j1:j2]
+            if ins_toks:
+                new_spans.append(added_segment(" ".join(ins_toks), other_bit))
+    return new_spans if new_spans else [s]
+
+def project_editions(segments: List[Segment]) -> Dict[str, str]:
+    # Each witness's text of an <l>, for every witness in one walk over the segments: the
+    # segments the witness has, with its change text for replaced readings.
+    parts = {ed: [] for ed in EDITIONS}
     for s in segments:
-        if edition in s["editions"]:
-            if s["type"].startswith("added_in_"):
-                if edition in s["editions"]:
-                    parts.append(s["text"])
-            elif s["type"] == "replaced":
-                if edition == BASE_EDITION:
-                    parts.append(s["text"])
-                else:
-                    ch = next((c for c in s.get("changes", []) if c["edition"] == edition), None)
-                    if ch:
-                        parts.append(ch.get("text", s["text"]))
-                    else:
-                        parts.append(s["text"])
-            else:
-                parts.append(s["text"])
+        if s.kind == REPLACED and s.changes:
+            # First change per witness wins.
+            changed = {}
+            for c in s.changes:
+                changed.setdefault(c["edition"], c.get("text", s.text))
+            changed[BASE_EDITION] = s.text
+            for ed in editions_of(s.editions):
+                parts[ed].append(changed.get(ed, s.text))
         else:
-            continue
-    return "".join(parts)
+            for ed in editions_of(s.editions):
+                parts[ed].append(s.text)
+    return {ed: "".join(p) for ed, p in parts.items()}
 
-def build_segments_from_l(l_elem) -> List[Dict]:
-    segments: List[Dict] = []
+def build_raw_segments(l_elem) -> List[Segment]:
+    # Segments for one <l> before post-processing.
+    segments: List[Segment] = []
     current_literal: List[str] = []
 
     def flush_literal():
@@ -328,14 +473,7 @@ def build_segments_from_l(l_elem) -> List[Dict]:
             raw = "".join(current_literal)
             s = normalize_literal(raw)
             if s.strip():
-                segments.append({
-                    "text": s,
-                    "type": "original",
-                    "variant_type": None,
-                    "editions": EDITIONS,
-                    "source": BASE_EDITION,
-                    "changes": []
-                })
+                segments.append(Segment(s, ORIGINAL, ALL_EDITIONS, BASE_EDITION))
             current_literal.clear()
 
     if l_elem.text:
@@ -346,10 +484,11 @@ def build_segments_from_l(l_elem) -> List[Dict]:
             flush_literal()
             texts = {e: "" for e in EDITIONS}
             for rdg in child.findall("./tei:rdg", NS):
-                wit = rdg.get("wit", "").strip().lstrip("#")
                 val = normalize_text(rdg.text or "")
-                if wit in texts:
-                    texts[wit] = val
+                for wit in rdg.get("wit", "").split():
+                    wit = wit.lstrip("#")
+                    if wit in texts:
+                        texts[wit] = val
 
             vtype, vsub, eds = classify_variant(texts)
 
@@ -358,24 +497,9 @@ def build_segments_from_l(l_elem) -> List[Dict]:
             elif vtype.startswith("added_in_"):
                 for ed in eds:
                     if texts[ed]:
-                        segments.append({
-                            "text": texts[ed],
-                            "type": f"added_in_{ed}",
-                            "variant_type": "addition",
-                            "editions": [ed],
-                            "source": ed,
-                            "_first_added": ed,
-                            "changes": []
-                        })
+                        segments.append(added_segment(texts[ed], EDITION_BITS[ed]))
             elif vtype == "original":
-                segments.append({
-                    "text": texts[BASE_EDITION],
-                    "type": "original",
-                    "variant_type": None,
-                    "editions": EDITIONS,
-                    "source": BASE_EDITION,
-                    "changes": []
-                })
+                segments.append(Segment(texts[BASE_EDITION], ORIGINAL, ALL_EDITIONS, BASE_EDITION))
             elif vtype == "replaced":
                 if eds:
                     base_text = texts.get(BASE_EDITION, "") or texts.get(eds[0], "")
@@ -398,14 +522,13 @@ def build_segments_from_l(l_elem) -> List[Dict]:
                                 "char_level": char_level_diff(base_text, other_text),
                                 "note": "Substitution (char-level)"
                             })
-                    segments.append({
-                        "text": base_text,
-                        "type": "replaced",
-                        "variant_type": vsub,
-                        "editions": sorted(eds, key=lambda e: EDITIONS.index(e)),
-                        "source": BASE_EDITION if texts.get(BASE_EDITION) else eds[0],
-                        "changes": changes
-                    })
+                    segments.append(Segment(
+                        base_text,
+                        REPLACED,
+                        edition_mask(eds),
+                        BASE_EDITION if texts.get(BASE_EDITION) else eds[0],
+                        tuple(changes)
+                    ))
             if child.tail:
                 current_literal.append(child.tail)
         else:
@@ -415,39 +538,32 @@ def build_segments_from_l(l_elem) -> List[Dict]:
                 current_literal.append(child.tail)
 
     flush_literal()
-    segments = [s for s in segments if s["text"]]
-    segments = coalesce_spans(segments)
-    segments = cleanup_punctuation(segments)
-    segments = trim_space_before_punct_spans(segments)
-    segments = reconcile_conflicting_additions(segments)
-    segments = coalesce_spans(segments)
-    segments = split_replaced_tokenwise(segments)
-    segments = coalesce_spans(segments)
-    segments = add_word_boundaries(segments)
     return segments
 
+def build_segments_from_l(l_elem) -> List[Segment]:
+    return postprocess_segments(build_raw_segments(l_elem))
+
+WORD_RE = re.compile(r"\w+")
+
 def tokenize(text: str) -> set:
-    return set(re.findall(r"\w+", text.lower()))
+    return set(WORD_RE.findall(text.lower()))
 
-def jaccard_similarity(a: str, b: str) -> float:
-    A, B = tokenize(a), tokenize(b)
+def jaccard_sets(A: set, B: set) -> float:
     if not A and not B:
         return 1.0
     inter = len(A & B)
-    union = len(A | B)
+    union = len(A) + len(B) - inter
     return inter / union if union else 1.0
 
-def compute_similarity(segments: List[Dict]) -> float:
-    base_text = reconstruct_for_edition(segments, BASE_EDITION)
-    sims = []
-    for ed in EDITIONS:
-        if ed == BASE_EDITION:
-            continue
-        ed_text = reconstruct_for_edition(segments, ed)
-        sims.append(jaccard_similarity(base_text, ed_text))
+def compute_similarity(segments: List[Segment], texts: Dict[str, str] = None) -> float:
+    # texts: project_editions(segments), if the caller already has it.
+    if texts is None:
+        texts = project_editions(segments)
+    base_tokens = tokenize(texts[BASE_EDITION])
+    sims = [jaccard_sets(base_tokens, tokenize(texts[ed])) for ed in EDITIONS if ed != BASE_EDITION]
     return sum(sims) / len(sims) if sims else 1.0
 
-def compute_para_stats(segments: List[Dict]) -> Dict:
+def compute_para_stats(segments: List[Segment], texts: Dict[str, str] = None) -> Dict:
     stats = {
         "additions": 0,
         "deletions": 0,
@@ -457,7 +573,7 @@ def compute_para_stats(segments: List[Dict]) -> Dict:
         "similarity": 1.0
     }
     for s in segments:
-        vt = s.get("variant_type")
+        vt = s.variant_type
         if vt is None:
             continue
         stats["total_variants"] += 1
@@ -469,7 +585,7 @@ def compute_para_stats(segments: List[Dict]) -> Dict:
             stats["substitutions"] += 1
         elif vt == "orthographic":
             stats["orthographic"] += 1
-    stats["similarity"] = compute_similarity(segments)
+    stats["similarity"] = compute_similarity(segments, texts)
     return stats
 
 def add_to_global(global_stats: Dict, para_stats: Dict):
@@ -478,10 +594,8 @@ def add_to_global(global_stats: Dict, para_stats: Dict):
             continue
         global_stats[k] = global_stats.get(k, 0) + v
 
-def build_slots(root) -> Dict:
-    l_elems = extract_l_elements(root)
-    content = []
-    global_stats = {
+def new_global_stats() -> Dict:
+    return {
         "paragraphs": 0,
         "additions": 0,
         "deletions": 0,
@@ -489,42 +603,556 @@ def build_slots(root) -> Dict:
         "orthographic": 0,
         "total_variants": 0
     }
-    for idx, l in enumerate(l_elems):
-        num = l.get("n")
-        segments = build_segments_from_l(l)
-        para_stats = compute_para_stats(segments)
-        add_to_global(global_stats, para_stats)
-        global_stats["paragraphs"] += 1
-        content.append({
-            "index": idx,
-            "data": {
-                "number": int(num) if num and num.isdigit() else num,
-                "meta": { "slot_note": f"L n={num} from VM; witnesses {','.join(EDITIONS)}" },
-                "unified_text": segments,
-                "note_positions": {},
-                "notes": [],
-                "apparatus": "auto-generated from VM",
-                "stats": para_stats
-            }
-        })
+
+def build_slot_entry(idx: int, l_elem) -> Tuple[Dict, Dict]:
+    if PROFILER is not None:
+        return profile_slot_entry(idx, l_elem)
+    segments = build_segments_from_l(l_elem)
+    para_stats = compute_para_stats(segments, project_editions(segments))
+    return make_slot_entry(idx, l_elem, segments, para_stats), para_stats
+
+def profile_slot_entry(idx: int, l_elem) -> Tuple[Dict, Dict]:
+    # build_slot_entry split into profiler stages; the <l> is timed as one item.
+    num = l_elem.get("n")
+    with PROFILER.item(f"l n={num}", {"index": idx, "n": num}) as info:
+        with PROFILER.stage("segment"):
+            raw = build_raw_segments(l_elem)
+        with PROFILER.stage("postprocess"):
+            segments = postprocess_segments(raw)
+        with PROFILER.stage("project"):
+            texts = project_editions(segments)
+        with PROFILER.stage("stats"):
+            para_stats = compute_para_stats(segments, texts)
+        with PROFILER.stage("entry"):
+            entry = make_slot_entry(idx, l_elem, segments, para_stats)
+    # Counted after the item is timed, so the counting is not part of it.
+    info["segments"] = len(segments)
+    info["tokens"] = {ed: len(text.split()) for ed, text in texts.items()}
+    return entry, para_stats
+
+def l_number(l_elem):
+    num = l_elem.get("n")
+    return int(num) if num and num.isdigit() else num
+
+def make_slot_entry(idx: int, l_elem, segments: List[Segment], para_stats: Dict) -> Dict:
+    num = l_elem.get("n")
     return {
-        "meta": {
-            "generated_at": "2025-12-05T00:00:00Z",
+        "index": idx,
+        "data": {
+            "number": l_number(l_elem),
+            "meta": { "slot_note": f"L n={num} from VM; witnesses {','.join(EDITIONS)}" },
+            "unified_text": [s.to_json() for s in segments],
+            "note_positions": {},
+            "notes": [],
+            "apparatus": "auto-generated from VM",
+            "stats": para_stats
+        }
+    }
+
+def build_slot_entries(indexed_l) -> Tuple[List[Dict], Dict]:
+    entries = []
+    partial_stats = new_global_stats()
+    for idx, l in indexed_l:
+        entry, para_stats = build_slot_entry(idx, l)
+        add_to_global(partial_stats, para_stats)
+        partial_stats["paragraphs"] += 1
+        entries.append(entry)
+    return entries, partial_stats
+
+# Worker side of the pool: entries for serialized <l> elements plus their summed stats.
+def build_slot_chunk(chunk: List[Tuple[int, bytes]]) -> Tuple[List[Dict], Dict]:
+    return build_slot_entries((idx, ET.fromstring(l_xml)) for idx, l_xml in chunk)
+
+def iter_l_chunks(l_elems, chunk_size: int):
+    chunk = []
+    for idx, l in enumerate(l_elems):
+        chunk.append((idx, ET.tostring(l)))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_l_elements(xml_path: str):
+    # Yields body <l> elements as soon as they are parsed and clears each one once
+    # the consumer moves on, so the document is never held in memory as a whole.
+    body_tag = f"{{{NS['tei']}}}body"
+    l_tag = f"{{{NS['tei']}}}l"
+    in_body = 0
+    for event, elem in ET.iterparse(xml_path, events=("start", "end")):
+        if elem.tag == body_tag:
+            in_body += 1 if event == "start" else -1
+        elif event == "end" and in_body and elem.tag == l_tag:
+            yield elem
+            elem.clear()
+
+def l_cache_key(l_xml: bytes) -> str:
+    # Hash of the ET.tostring bytes, which are stable for a given <l>; canonicalizing cost
+    # more than converting. The tail (whitespace after </l>, which iterparse may not have
+    # read yet) is cut off; ET.tostring escapes ">" in text, so the last one closes the <l>.
+    salt = f"{CONVERTER_VERSION}|{','.join(EDITIONS)}|{BASE_EDITION}|{DIFF_ENGINE}|{CHAR_DIFF_MAX_LEN}|"
+    return hashlib.sha256(salt.encode("utf-8") + l_xml[:l_xml.rindex(b">") + 1]).hexdigest()
+
+class SlotCache:
+    # Persistent (SQLite) store of finished slot entry data per <l>, keyed by l_cache_key.
+    def __init__(self, path: str, threads: bool = False):
+        # threads: used from --serve request threads (one at a time, under the server's lock)
+        self.conn = sqlite3.connect(path, check_same_thread=not threads)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS slots (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.hits = 0
+        self.misses = 0
+        self.seen = set()
+
+    def get(self, key: str):
+        self.seen.add(key)
+        row = self.conn.execute("SELECT data FROM slots WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, data: Dict):
+        self.conn.execute("INSERT OR REPLACE INTO slots (key, data) VALUES (?, ?)",
+                          (key, json.dumps(data, ensure_ascii=False)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def prune(self) -> int:
+        # After a full export every <l> of the run has been looked up; rows of edited or
+        # removed <l> elements (and of other settings) are dropped so the cache does not grow.
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM seen")
+        self.conn.executemany("INSERT INTO seen (key) VALUES (?)", ((key,) for key in self.seen))
+        return self.conn.execute("DELETE FROM slots WHERE key NOT IN (SELECT key FROM seen)").rowcount
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def collect_slot_chunk(entries: List[Dict]) -> Tuple[List[Dict], Dict]:
+    partial_stats = new_global_stats()
+    for entry in entries:
+        add_to_global(partial_stats, entry["data"]["stats"])
+        partial_stats["paragraphs"] += 1
+    return entries, partial_stats
+
+def plan_cached_chunk(chunk: List[Tuple[int, bytes]], cache: SlotCache):
+    keys = {}
+    cached = {}
+    misses = []
+    for idx, l_xml in chunk:
+        with profile_stage("cache"):
+            keys[idx] = l_cache_key(l_xml)
+            data = cache.get(keys[idx])
+        if data is None:
+            misses.append((idx, l_xml))
+        else:
+            cached[idx] = {"index": idx, "data": data}
+    return keys, cached, misses
+
+def merge_cached_chunk(plan, built: List[Dict], cache: SlotCache) -> Tuple[List[Dict], Dict]:
+    keys, cached, _ = plan
+    for entry in built:
+        cache.put(keys[entry["index"]], entry["data"])
+        cached[entry["index"]] = entry
+    return collect_slot_chunk([cached[idx] for idx in keys])
+
+def iter_cached_slot_chunks(l_elems, cache: SlotCache, jobs: int = 1, chunk_size: int = 32):
+    # Only <l> elements whose serialization is not cached yet are rebuilt.
+    plans = (plan_cached_chunk(chunk, cache) for chunk in iter_l_chunks(l_elems, chunk_size))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=(DIFF_ENGINE, CHAR_DIFF_MAX_LEN, EDITIONS, BASE_EDITION)) as executor:
+            submitted = [
+                (plan, executor.submit(build_slot_chunk, plan[2]) if plan[2] else None)
+                for plan in plans
+            ]
+            for plan, future in submitted:
+                yield merge_cached_chunk(plan, future.result()[0] if future else [], cache)
+    else:
+        for plan in plans:
+            yield merge_cached_chunk(plan, build_slot_chunk(plan[2])[0] if plan[2] else [], cache)
+
+def iter_slot_chunks(l_elems, jobs: int = 1, chunk_size: int = 32, cache: SlotCache = None):
+    if cache is not None:
+        yield from iter_cached_slot_chunks(l_elems, cache, jobs, chunk_size)
+    elif jobs > 1:
+        # Chunks come back in submission order, so content stays in index order.
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=(DIFF_ENGINE, CHAR_DIFF_MAX_LEN, EDITIONS, BASE_EDITION)) as executor:
+            yield from executor.map(build_slot_chunk, iter_l_chunks(l_elems, chunk_size))
+    else:
+        for idx, l in enumerate(l_elems):
+            yield build_slot_entries([(idx, l)])
+
+class SlotIndex:
+    # Search/filter index written next to the slot JSON with --index. Built from finished
+    # entries (so cached and worker-built entries are indexed alike): NFC, casefolded word ->
+    # {paragraph index: witness mask} over each witness's reconstructed text, and
+    # variant type -> paragraph indices.
+
+    def __init__(self):
+        self.words: Dict[str, Dict[int, int]] = {}
+        self.variants: Dict[str, set] = {}
+        self.paragraphs = 0
+
+    def add_entry(self, entry: Dict, texts: Dict[str, str]):
+        # texts: project_entry(entry's unified_text)
+        idx = entry["index"]
+        self.paragraphs += 1
+        for ed, text in texts.items():
+            bit = EDITION_BITS[ed]
+            for word in set(WORD_RE.findall(nfc(text).casefold())):
+                postings = self.words.setdefault(word, {})
+                postings[idx] = postings.get(idx, 0) | bit
+        for span in entry["data"]["unified_text"]:
+            if span["variant_type"]:
+                self.variants.setdefault(span["variant_type"], set()).add(idx)
+
+    def to_json(self) -> Dict:
+        # Postings are flattened to [paragraph, mask, paragraph, mask, ...] in paragraph order.
+        return {
             "editions": EDITIONS,
-            "generator": "vm-to-slot-sample",
-            "stats": global_stats
-        },
+            "paragraphs": self.paragraphs,
+            "words": {
+                word: [n for idx in sorted(postings) for n in (idx, postings[idx])]
+                for word, postings in sorted(self.words.items())
+            },
+            "variants": {vt: sorted(idxs) for vt, idxs in sorted(self.variants.items())}
+        }
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f, profile_stage("index"):
+            f.write(json_dumps(self.to_json(), None))
+
+class PlainTextWriter:
+    # --plain-text DIR: DIR/<witness>.txt, one "<l n>\t<witness text>" line per paragraph,
+    # whitespace collapsed so every paragraph stays on its line.
+    def __init__(self, out_dir: str):
+        os.makedirs(out_dir, exist_ok=True)
+        self.files = {ed: open(os.path.join(out_dir, f"{ed}.txt"), "w", encoding="utf-8") for ed in EDITIONS}
+
+    def add_entry(self, entry: Dict, texts: Dict[str, str]):
+        num = entry["data"]["number"]
+        for ed, text in texts.items():
+            self.files[ed].write(f"{num}\t{' '.join(text.split())}\n")
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+def project_entry(spans: List[Dict]) -> Dict[str, str]:
+    # project_editions over the JSON spans of a slot entry, so cached and worker-built
+    # entries feed the consumers alike.
+    parts = {ed: [] for ed in EDITIONS}
+    for s in spans:
+        if s["type"] == "replaced" and s["changes"]:
+            changed = {}
+            for c in s["changes"]:
+                changed.setdefault(c["edition"], c.get("text", s["text"]))
+            changed[BASE_EDITION] = s["text"]
+            for ed in s["editions"]:
+                parts[ed].append(changed.get(ed, s["text"]))
+        else:
+            for ed in s["editions"]:
+                parts[ed].append(s["text"])
+    return {ed: "".join(p) for ed, p in parts.items()}
+
+def feed_consumers(consumers: List, entries: List[Dict]):
+    # One projection per entry, shared by the index and the plain-text output.
+    if consumers:
+        with profile_stage("index"):
+            for entry in entries:
+                texts = project_entry(entry["data"]["unified_text"])
+                for consumer in consumers:
+                    consumer.add_entry(entry, texts)
+
+def slot_meta() -> Dict:
+    return {
+        "generated_at": "2025-12-05T00:00:00Z",
+        "editions": EDITIONS,
+        "generator": "vm-to-slot-sample"
+    }
+
+def build_slots(root, jobs: int = 1, chunk_size: int = 32, cache: SlotCache = None,
+                consumers: List = ()) -> Dict:
+    content = []
+    global_stats = new_global_stats()
+    for entries, partial_stats in iter_slot_chunks(extract_l_elements(root), jobs, chunk_size, cache):
+        add_to_global(global_stats, partial_stats)
+        feed_consumers(consumers, entries)
+        content.extend(entries)
+    meta = slot_meta()
+    meta["stats"] = global_stats
+    return {
+        "meta": meta,
         "content": content
     }
 
-def main(xml_path: str):
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    slot_json = build_slots(root)
-    json.dump(slot_json, sys.stdout, ensure_ascii=False, indent=2)
+def json_dumps(obj, indent) -> str:
+    if indent is None:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    return json.dumps(obj, ensure_ascii=False, indent=indent)
+
+def write_slots_streaming(l_elems, out, indent=2, jobs: int = 1, chunk_size: int = 32, stats_out=None,
+                          cache: SlotCache = None, consumers: List = ()) -> Dict:
+    # Same document as build_slots, except that the global stats are only known at the
+    # end: they follow "content" as a top-level "stats" key, or go to stats_out if given.
+    nl = "\n" if indent is not None else ""
+    pad = " " * (indent or 0)
+
+    def nested(obj, depth):
+        # JSON strings never contain raw newlines, so re-indenting line starts is safe.
+        return json_dumps(obj, indent).replace("\n", "\n" + pad * depth)
+
+    colon = ": " if indent is not None else ":"
+    out.write("{" + nl + pad + '"meta"' + colon + nested(slot_meta(), 1) + "," + nl + pad + '"content"' + colon + "[")
+    out.flush()
+    global_stats = new_global_stats()
+    first = True
+    for entries, partial_stats in iter_slot_chunks(l_elems, jobs, chunk_size, cache):
+        add_to_global(global_stats, partial_stats)
+        feed_consumers(consumers, entries)
+        for entry in entries:
+            with profile_stage("dump"):
+                out.write(("" if first else ",") + nl + pad * 2 + nested(entry, 2))
+            first = False
+        out.flush()
+    out.write("]" if first else nl + pad + "]")
+    if stats_out is None:
+        out.write("," + nl + pad + '"stats"' + colon + nested(global_stats, 1))
+    else:
+        stats_out.write(json_dumps(global_stats, indent))
+    out.write(nl + "}")
+    out.flush()
+    return global_stats
+
+def write_slot_shards(l_elems, out_dir: str, shard_size: int = 50, indent=2, jobs: int = 1,
+                      chunk_size: int = 32, cache: SlotCache = None, consumers: List = ()) -> Dict:
+    # Writes fixed-size content shards as paragraphs are built, then manifest.json with the
+    # global stats, a TOC and the shard ranges, so a viewer only fetches what it renders.
+    os.makedirs(out_dir, exist_ok=True)
+    global_stats = new_global_stats()
+    toc = []
+    shards = []
+    pending = []
+
+    def flush_shard():
+        start = len(shards) * shard_size
+        name = f"shard-{len(shards):05d}.json"
+        with open(os.path.join(out_dir, name), "w", encoding="utf-8") as f, profile_stage("dump"):
+            f.write(json_dumps({"start": start, "content": pending}, indent))
+        shards.append({"file": name, "start": start, "end": start + len(pending)})
+        pending.clear()
+
+    for entries, partial_stats in iter_slot_chunks(l_elems, jobs, chunk_size, cache):
+        add_to_global(global_stats, partial_stats)
+        feed_consumers(consumers, entries)
+        for entry in entries:
+            toc.append({"index": entry["index"], "number": entry["data"]["number"]})
+            pending.append(entry)
+            if len(pending) == shard_size:
+                flush_shard()
+    if pending:
+        flush_shard()
+
+    meta = slot_meta()
+    meta["stats"] = global_stats
+    manifest = {
+        "meta": meta,
+        "total": len(toc),
+        "shard_size": shard_size,
+        "toc": toc,
+        "shards": shards
+    }
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f, profile_stage("dump"):
+        f.write(json_dumps(manifest, indent))
+    return manifest
+
+def write_output(xml_path: str, jobs: int = 1, chunk_size: int = 32, stream: bool = False,
+                 compact: bool = False, stats_path: str = None, shard_dir: str = None,
+                 shard_size: int = 50, cache: SlotCache = None, index_path: str = None,
+                 plain_text_dir: str = None):
+    indent = None if compact else 2
+    index = SlotIndex() if index_path else None
+    plain_text = PlainTextWriter(plain_text_dir) if plain_text_dir else None
+    consumers = [c for c in (index, plain_text) if c is not None]
+    if stream:
+        l_elems = iter_l_elements(xml_path)
+        if PROFILER is not None:
+            l_elems = PROFILER.iterate(l_elems, "parse")
+    elif shard_dir:
+        with profile_stage("parse"):
+            l_elems = extract_l_elements(ET.parse(xml_path).getroot())
+    if shard_dir:
+        write_slot_shards(l_elems, shard_dir, shard_size, indent, jobs, chunk_size, cache, consumers)
+    elif stream:
+        if stats_path:
+            with open(stats_path, "w", encoding="utf-8") as stats_out:
+                write_slots_streaming(l_elems, sys.stdout, indent, jobs, chunk_size, stats_out, cache, consumers)
+        else:
+            write_slots_streaming(l_elems, sys.stdout, indent, jobs, chunk_size, cache=cache, consumers=consumers)
+    else:
+        with profile_stage("parse"):
+            root = ET.parse(xml_path).getroot()
+        slot_json = build_slots(root, jobs=jobs, chunk_size=chunk_size, cache=cache, consumers=consumers)
+        with profile_stage("dump"):
+            sys.stdout.write(json_dumps(slot_json, indent))
+    if index is not None:
+        index.write(index_path)
+    if plain_text is not None:
+        plain_text.close()
+
+class LazySlotSource:
+    # --serve: the export's <l> elements, parsed once and converted as the viewer asks for them.
+    # The export is re-read when it changes; <l> elements keep their l_cache_key, so only
+    # changed ones are rebuilt.
+    prefix = "slot_output/"
+
+    def __init__(self, xml_path: str, cache: SlotCache = None):
+        self.xml_path = xml_path
+        self.cache = cache
+        self.mtime = None
+        self.refresh()
+
+    def refresh(self):
+        if self.cache is not None:
+            self.cache.commit()
+        mtime = os.stat(self.xml_path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        self.l_elems = extract_l_elements(ET.parse(self.xml_path).getroot())
+        self.l_keys = [l_cache_key(ET.tostring(l)) for l in self.l_elems]
+        self.mtime = mtime
+        print(f"loaded {len(self.l_elems)} <l> from {self.xml_path}", file=sys.stderr)
+
+    def total(self) -> int:
+        return len(self.l_elems)
+
+    def manifest(self) -> Dict:
+        # The global stats need every paragraph, so the served manifest has none.
+        return {
+            "meta": slot_meta(),
+            "toc": [{"index": idx, "number": l_number(l)} for idx, l in enumerate(self.l_elems)]
+        }
+
+    def keys(self, start: int, end: int) -> List[str]:
+        return [f"{idx}:{self.l_keys[idx]}" for idx in range(start, end)]
+
+    def build(self, idx: int) -> Dict:
+        if self.cache is not None:
+            data = self.cache.get(self.l_keys[idx])
+            if data is not None:
+                return {"index": idx, "data": data}
+        entry, _ = build_slot_entry(idx, self.l_elems[idx])
+        if self.cache is not None:
+            self.cache.put(self.l_keys[idx], entry["data"])
+        return entry
+
+def serve_slots(xml_path: str, address: str, cache: SlotCache = None, shard_size: int = 50,
+                cache_size: int = 2000):
+    host, _, port = address.rpartition(":")
+    slot_server.serve(LazySlotSource(xml_path, cache), host or "127.0.0.1", int(port),
+                      shard_size=shard_size, cache_size=cache_size)
+
+def main(xml_path: str, cache_path: str = None, diff_engine: str = "difflib", check_diff: bool = False,
+         char_diff_max_len: int = CHAR_DIFF_MAX_LEN, profile_path: str = None, profile_top: int = 10,
+         serve: str = None, serve_cache: int = 2000, **options):
+    # Expects configure_witnesses to have run for xml_path.
+    if check_diff and options.get("jobs", 1) > 1:
+        # Worker processes keep their own tallies, so checking runs in-process.
+        print("--check-diff: running with --jobs 1", file=sys.stderr)
+        options["jobs"] = 1
+    if profile_path and options.get("jobs", 1) > 1:
+        print("--profile: running with --jobs 1", file=sys.stderr)
+        options["jobs"] = 1
+    engine = set_diff_engine(diff_engine, check_diff)
+    set_char_diff_max_len(char_diff_max_len)
+    if profile_path:
+        set_profiler(StageProfiler(profile_top))
+        PROFILER.start()
+    try:
+        cache = SlotCache(cache_path, threads=bool(serve)) if cache_path else None
+        try:
+            if serve:
+                serve_slots(xml_path, serve, cache, options.get("shard_size", 50), serve_cache)
+            else:
+                write_output(xml_path, cache=cache, **options)
+                if cache is not None:
+                    pruned = cache.prune()
+                    print(f"cache: {pruned} stale <l> entries pruned", file=sys.stderr)
+        finally:
+            if cache is not None:
+                cache.close()
+                print(f"cache: {cache.hits} <l> reused, {cache.misses} rebuilt", file=sys.stderr)
+    finally:
+        if profile_path:
+            profiler = PROFILER
+            set_profiler(None)
+            profiler.stop()
+            profiler.write(profile_path)
+            print(profiler.summary(), file=sys.stderr)
+            print(f"profile: wrote {profile_path}", file=sys.stderr)
+    if check_diff:
+        engine.report()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python vm_to_slot.py <vm_tei.xml>", file=sys.stderr)
-        sys.exit(1)
-    main(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Convert Versioning Machine XML to slot JSON.")
+    parser.add_argument("xml_path", metavar="vm_tei.xml")
+    parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                        help="process <l> elements in N worker processes (default: 1)")
+    parser.add_argument("--chunk-size", type=int, default=32, metavar="N",
+                        help="<l> elements sent to a worker at a time (default: 32)")
+    parser.add_argument("--stream", action="store_true",
+                        help="write each paragraph as soon as it is built; global stats follow the content")
+    parser.add_argument("--compact", action="store_true",
+                        help="write JSON without indentation")
+    parser.add_argument("--stats-file", metavar="PATH",
+                        help="with --stream, write the global stats to PATH instead of the main document")
+    parser.add_argument("--shard-dir", metavar="DIR",
+                        help="write DIR/manifest.json plus paragraph shards instead of one document on stdout")
+    parser.add_argument("--shard-size", type=int, default=50, metavar="N",
+                        help="paragraphs per shard (default: 50)")
+    parser.add_argument("--cache", metavar="PATH",
+                        help="reuse results for unchanged <l> elements from the SQLite cache at PATH")
+    parser.add_argument("--diff-engine", choices=list(ENGINES), default="difflib",
+                        help="token diff algorithm for the token-level passes; myers (also used by patience) "
+                             f"falls back to difflib matching past {MYERS_MAX_D} edits (default: difflib)")
+    parser.add_argument("--check-diff", action="store_true",
+                        help="validate every token diff and report how it compares with difflib")
+    parser.add_argument("--witnesses", metavar="ID,ID,...",
+                        help="witness ids in chronological order (default: the <listWit> order)")
+    parser.add_argument("--base", metavar="ID",
+                        help="base witness for replaced readings (default: the latest witness)")
+    parser.add_argument("--index", metavar="PATH",
+                        help="also write a search/filter index (word and variant type -> paragraphs) to PATH")
+    parser.add_argument("--plain-text", metavar="DIR",
+                        help="also write each witness's text to DIR/<witness>.txt, one line per <l>")
+    parser.add_argument("--serve", metavar="[HOST:]PORT",
+                        help="serve the current directory and build slot_output/ shards on demand "
+                             "instead of writing output")
+    parser.add_argument("--serve-cache", type=int, default=2000, metavar="N",
+                        help="with --serve, built paragraphs kept in memory (default: 2000)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="write per-stage wall/CPU time, tracemalloc peaks and the slowest <l> to PATH as JSON")
+    parser.add_argument("--profile-top", type=int, default=10, metavar="N",
+                        help="slowest <l> elements listed in the profile (default: 10)")
+    parser.add_argument("--char-diff-max-len", type=int, default=CHAR_DIFF_MAX_LEN, metavar="N",
+                        help="readings longer than N characters get token-level ops instead of a "
+                             f"character diff; 0 disables (default: {CHAR_DIFF_MAX_LEN})")
+    args = parser.parse_args()
+    if args.serve and (args.profile or args.index or args.plain_text or args.shard_dir):
+        parser.error("--serve builds paragraphs on request; --profile, --index, --plain-text "
+                     "and --shard-dir need a full run")
+    try:
+        configure_witnesses(args.xml_path, args.witnesses.split(",") if args.witnesses else None, args.base)
+    except ValueError as exc:
+        parser.error(str(exc))
+    main(args.xml_path, cache_path=args.cache, jobs=args.jobs, chunk_size=args.chunk_size,
+         stream=args.stream, compact=args.compact, stats_path=args.stats_file,
+         shard_dir=args.shard_dir, shard_size=args.shard_size, diff_engine=args.diff_engine,
+         check_diff=args.check_diff, char_diff_max_len=args.char_diff_max_len,
+         profile_path=args.profile, profile_top=args.profile_top,
+         index_path=args.index, plain_text_dir=args.plain_text, serve=args.serve, serve_cache=args.serve_cache)